@@ -0,0 +1,89 @@
+"""
+Check the start-up time budget of slm.
+
+It runs `python -X importtime -c "import slm.main"` several times, takes the
+best cumulative import time of `slm.main`, and fails if it is over budget or
+if a module which should be imported lazily is imported.
+
+usage: python benchmark/import_time.py [--budget-ms 250] [--runs 5]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# modules which connect to something or are slow to import, they are only
+# needed by commands which use them
+LAZY_MODULES = ["libtmux", "pynput", "cryptography", "treelib"]
+
+
+def measure(python, env):
+    """
+    :python: path of python interpreter
+    :env: environment of the subprocess
+    :returns: (cumulative microseconds of slm.main, names of imported modules)
+
+    """
+    process = subprocess.run(
+        [python, "-X", "importtime", "-c", "import slm.main"],
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    total = None
+    modules = set()
+    for line in str(process.stderr, "utf8").splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        modules.add(name)
+        if name == "slm.main":
+            total = int(fields[1])
+    if total is None:
+        raise Exception("slm.main is not imported")
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check start-up time budget")
+    parser.add_argument("--budget-ms", type=float, default=250)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--python", default=sys.executable)
+    args = parser.parse_args()
+
+    src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.normpath(src_path)]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+
+    results = [measure(args.python, env) for _ in range(args.runs)]
+    best = min(total for total, _ in results) / 1000
+    imported = sorted(
+        {
+            name
+            for _, modules in results
+            for name in modules
+            if name.split(".")[0] in LAZY_MODULES
+        }
+    )
+    print("import slm.main: {:.1f}ms, budget: {:.1f}ms".format(best, args.budget_ms))
+
+    failed = False
+    if best > args.budget_ms:
+        print("start-up time is over budget")
+        failed = True
+    if len(imported) > 0:
+        print("modules imported eagerly: {}".format(", ".join(imported)))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""
+Benchmark login info at scale on a synthetic LOGIN_INFO_ROOT_PATH tree.
+
+A tree of `depth` levels of directories is generated, every directory has
+`fanout` sub directories and every leaf directory has `hosts` host files.
+Directories in the first `base-depth` levels have a .base.yaml, so hosts
+inherit properties through that many levels.
+
+It times loading, reloading, searching, listing, completion, `ls` and
+resolving every heritable property, and writes the results as json. Pass
+the json of another version with --baseline to compare them, it fails if
+any operation is slower than the baseline by more than --tolerance.
+
+The script can be copied into an older checkout to produce the baseline,
+features it lacks, like the compiled inventory, lazy loading or reload,
+are detected and their modes or operations are skipped.
+
+usage: python benchmark/inventory.py [--depth 3] [--fanout 10] [--hosts 10]
+           [--base-depth 3] [--output result.json] [--baseline old.json]
+"""
+
+import argparse
+import contextlib
+import inspect
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+from slm.command.ls_command import LsCommand  # noqa: E402
+from slm.login_info.login_info import LoginInfo  # noqa: E402
+from slm.login_info.login_info_manager import LoginInfoManager  # noqa: E402
+
+try:
+    from slm.login_info.inventory import CompiledLoginInfoManager  # noqa: E402
+except ImportError:
+    # an older version without the compiled inventory
+    CompiledLoginInfoManager = None
+
+# optional arguments of LoginInfoManager in this version, e.g. loading and workers
+MANAGER_ARGUMENTS = set(inspect.signature(LoginInfoManager.__init__).parameters)
+
+# properties wrapped by `heritable`, the same as the show command
+HERITABLE_PROPERTIES = sorted(
+    field
+    for field in dir(LoginInfo)
+    if not field.startswith("_") and hasattr(getattr(LoginInfo, field), "__wrapped__")
+)
+
+
+def _write(path, content):
+    with open(path, "w") as fout:
+        fout.write(content)
+
+
+def _join_id(parent_id, name):
+    return name if parent_id == "" else parent_id + "." + name
+
+
+def generate_tree(root_path, depth, fanout, hosts, base_depth):
+    """
+    Generate a synthetic login info tree.
+
+    :root_path: an empty directory
+    :depth: levels of directories
+    :fanout: sub directories of every directory
+    :hosts: host files in every leaf directory
+    :base_depth: levels of directories which have a .base.yaml
+    :returns: (ids of directories, ids of hosts)
+
+    """
+    _write(
+        os.path.join(root_path, ".base.yaml"),
+        "CREDENTIAL:\n"
+        "  - USER: admin\n"
+        "    PASSWORD: secret\n"
+        "  - USER: readonly\n"
+        "    PASSWORD: secret\n"
+        "  - DEFAULT: 0\n"
+        "PASSWORD_PROMPT: 'password:'\n"
+        "SHELL_PROMPT: '$'\n"
+        "PORT: 22\n",
+    )
+    dir_ids = []
+    host_ids = []
+    count = 0
+    # (path, id, level)
+    pending = [(root_path, "", 0)]
+    while len(pending) > 0:
+        path, id, level = pending.pop()
+        if level > 0 and level <= base_depth:
+            _write(
+                os.path.join(path, ".base.yaml"),
+                "SHELL_PROMPT: 'l{}$'\nAFTER_HOOKS: [['cd /tmp', 'export L={}']]\n".format(
+                    level, level
+                ),
+            )
+        if level == depth:
+            for i in range(hosts):
+                count += 1
+                name = "host{:02d}.yaml".format(i)
+                _write(
+                    os.path.join(path, name),
+                    "HOST: 10.{}.{}.{}\n".format(
+                        count >> 16 & 255, count >> 8 & 255, count & 255
+                    ),
+                )
+                host_ids.append(_join_id(id, name))
+            continue
+        for i in range(fanout):
+            name = "l{}n{:02d}".format(level, i)
+            sub_path = os.path.join(path, name)
+            os.mkdir(sub_path)
+            sub_id = _join_id(id, name)
+            dir_ids.append(sub_id)
+            pending.append((sub_path, sub_id, level + 1))
+    return dir_ids, host_ids
+
+
+def timeit(func, repeat):
+    """:returns: the best seconds of calling func repeat times"""
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def search_texts(ids, amount, seed):
+    """texts users may type: segments, segment prefixes and substrings of ids"""
+    rnd = random.Random(seed)
+    texts = []
+    for _ in range(amount):
+        id = rnd.choice(ids)
+        segment = rnd.choice(id.split("."))
+        kind = rnd.randrange(3)
+        if kind == 0:
+            texts.append(segment)
+        elif kind == 1:
+            texts.append(segment[: max(1, len(segment) // 2)])
+        else:
+            begin = rnd.randrange(len(id) - 2)
+            texts.append(id[begin : begin + 3])
+    return texts
+
+
+def unsupported_reason(args):
+    """:returns: why the arguments can't run in this version, or None"""
+    if args.manager == "compiled" and CompiledLoginInfoManager is None:
+        return "there is no compiled inventory"
+    if args.loading != "eager" and "loading" not in MANAGER_ARGUMENTS:
+        return "there is no {} loading".format(args.loading)
+    if args.workers != 1 and "workers" not in MANAGER_ARGUMENTS:
+        return "login info can't be loaded by workers"
+    return None
+
+
+def run(args, root_path, work_path):
+    dir_ids, host_ids = generate_tree(
+        root_path, args.depth, args.fanout, args.hosts, args.base_depth
+    )
+    all_ids = dir_ids + host_ids
+    inventory_path = os.path.join(work_path, "inventory")
+
+    def create():
+        if args.manager == "compiled":
+            return CompiledLoginInfoManager(root_path, inventory_path)
+        kwargs = {}
+        if "loading" in MANAGER_ARGUMENTS:
+            kwargs["loading"] = args.loading
+        if "workers" in MANAGER_ARGUMENTS:
+            kwargs["workers"] = args.workers
+        return LoginInfoManager(root_path, **kwargs)
+
+    if args.manager == "compiled":
+        compile_seconds = timeit(
+            lambda: CompiledLoginInfoManager.compile(root_path, inventory_path),
+            1,
+        )
+    results = {}
+
+    def record(name, seconds, ops=1):
+        # e.g. there are no directories to list in a tree of depth 0
+        if ops == 0:
+            return
+        results[name] = {
+            "seconds": seconds,
+            "ops": ops,
+            "us_per_op": seconds * 1e6 / ops,
+        }
+
+    if args.manager == "compiled":
+        record("compile", compile_seconds)
+    record("load", timeit(create, args.repeat))
+
+    # heritable properties are memoized, the first pass resolves them
+    def resolve_all(manager):
+        for id in all_ids:
+            login_info = manager.node(id).login_info()
+            for field in HERITABLE_PROPERTIES:
+                getattr(login_info, field)(is_raw=True)
+                getattr(login_info, field)()
+
+    ops = len(all_ids) * len(HERITABLE_PROPERTIES) * 2
+    record(
+        "resolve_heritable_cold",
+        min(timeit(lambda: resolve_all(create()), 1) for _ in range(args.repeat)),
+        ops,
+    )
+    manager = create()
+    resolve_all(manager)
+    record(
+        "resolve_heritable_warm", timeit(lambda: resolve_all(manager), args.repeat), ops
+    )
+
+    if hasattr(manager, "reload"):
+        record("reload_unchanged", timeit(manager.reload, args.repeat))
+        rnd = random.Random(args.seed)
+        modified_ids = rnd.sample(host_ids, max(1, len(host_ids) // 100))
+
+        def modify_and_reload():
+            for id in modified_ids:
+                # a different size makes sure the change is detected
+                with open(manager.node(id).config_path(), "a") as fout:
+                    fout.write("PORT: 2222\n")
+            manager.reload()
+
+        record(
+            "reload_modified", timeit(modify_and_reload, args.repeat), len(modified_ids)
+        )
+
+    texts = search_texts(all_ids, args.searches, args.seed)
+    record(
+        "search_nodes",
+        timeit(lambda: [manager.search_nodes(text) for text in texts], args.repeat),
+        len(texts),
+    )
+    command = LsCommand(None, None, manager)
+    record(
+        "complete_node",
+        timeit(lambda: [command.complete_node(text) for text in texts], args.repeat),
+        len(texts),
+    )
+    prefixes = [id for id in dir_ids if "." not in id]
+    record(
+        "list_nodes",
+        timeit(lambda: [manager.list_nodes(id) for id in prefixes], args.repeat),
+        len(prefixes),
+    )
+
+    def ls(node_id):
+        with contextlib.redirect_stdout(io.StringIO()):
+            command.run_x(node_id)
+
+    record("ls_root", timeit(lambda: ls(""), args.repeat))
+    record(
+        "ls_top_level",
+        timeit(lambda: [ls(id) for id in prefixes], args.repeat),
+        len(prefixes),
+    )
+    return {"dirs": len(dir_ids), "hosts": len(host_ids)}, results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print results against a baseline.
+
+    :returns: True if nothing is slower than the baseline beyond tolerance
+    """
+    ok = True
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["us_per_op"] / max(base["us_per_op"], 1e-9)
+        regressed = ratio > 1 + tolerance
+        ok = ok and not regressed
+        print(
+            "{:<24} {:>12.1f}us {:>12.1f}us {:>7.2f}x{}".format(
+                name,
+                base["us_per_op"],
+                result["us_per_op"],
+                ratio,
+                " REGRESSED" if regressed else "",
+            ),
+            file=sys.stderr,
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark login info at scale")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=10)
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--base-depth", type=int, default=3)
+    parser.add_argument("--manager", choices=["plain", "compiled"], default="plain")
+    parser.add_argument("--loading", choices=["eager", "lazy"], default="eager")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--searches", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--root", help="directory to keep the generated tree")
+    parser.add_argument("--output", help="json file to write, default stdout")
+    parser.add_argument("--baseline", help="json file written by another version")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    skipped = unsupported_reason(args)
+    if skipped is not None:
+        # an empty result, operations missing in a baseline are not compared
+        print("skipped: {}".format(skipped), file=sys.stderr)
+        size, results = {}, {}
+    else:
+        work_path = tempfile.mkdtemp(prefix="slm-benchmark-")
+        try:
+            root_path = args.root or os.path.join(work_path, "login_info")
+            if os.path.exists(root_path):
+                raise Exception("{} exists".format(root_path))
+            os.makedirs(root_path)
+            size, results = run(args, root_path, work_path)
+        finally:
+            shutil.rmtree(work_path)
+
+    report = {
+        "benchmark": "inventory",
+        "python": platform.python_version(),
+        "params": {
+            k: v
+            for k, v in vars(args).items()
+            if k not in ("root", "output", "baseline", "tolerance")
+        },
+        "size": size,
+        "results": results,
+    }
+    if skipped is not None:
+        report["skipped"] = skipped
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(content)
+    else:
+        with open(args.output, "w") as fout:
+            fout.write(content + "\n")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fin:
+            baseline = json.load(fin)
+        if baseline.get("params") != report["params"]:
+            print("parameters are different from the baseline", file=sys.stderr)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
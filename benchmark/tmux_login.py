@@ -0,0 +1,351 @@
+"""
+Benchmark login and mlogin end to end against a private tmux server.
+
+A tmux server is started on a private socket (`tmux -L`), so the tmux
+server of the user is not touched. Hosts are logged in by a fake ssh script
+which prints a password prompt and a shell prompt after configurable delays,
+so no real server is needed.
+
+For every batch size it measures:
+
+- the latency of creating panes by new_tiled_panes
+- the latency of mlogin to that many hosts, and of login for one host
+- the number of tmux invocations, counted by a tmux shim put in PATH
+- cpu time of slm, of tmux clients and of the tmux server
+
+Results are written as json.
+
+usage: python benchmark/tmux_login.py [--hosts 1,10,50,100,200]
+           [--connect-delay 0.05] [--shell-delay 0.05] [--output result.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import slm.command as command  # noqa: E402
+from slm.manager import Manager  # noqa: E402
+from slm.util import tmux_util  # noqa: E402
+
+FAKE_SSH = """#!/bin/sh
+# fake ssh: fake-ssh <user> <host> <port>
+sleep {connect_delay}
+printf '%s@%s {password_prompt} ' "$1" "$2"
+read -r password
+[ "$password" = "secret" ] || {{ echo "Permission denied"; exit 1; }}
+sleep {shell_delay}
+exec env PS1="$2 {shell_prompt} " /bin/sh
+"""
+
+TMUX_SHIM = """#!/bin/sh
+echo "$$" >> {count_path}
+exec {tmux} "$@"
+"""
+
+RESULT_RE = re.compile(r"(\d+) succeeded, (\d+) failed")
+
+
+def _write(path, content, mode=0o644):
+    with open(path, "w") as fout:
+        fout.write(content)
+    os.chmod(path, mode)
+
+
+class Harness(object):
+    """a private tmux server, fake ssh and login info of hosts in batches"""
+
+    def __init__(self, args, work_path):
+        self._args = args
+        self._work_path = work_path
+        self._tmux = shutil.which("tmux")
+        if self._tmux is None:
+            raise Exception("tmux is not found")
+        self._socket_name = args.socket_name or "slm-benchmark-{}".format(os.getpid())
+        self._count_path = os.path.join(work_path, "tmux_invocations")
+        _write(self._count_path, "")
+        self._server_pid = None
+
+        bin_path = os.path.join(work_path, "bin")
+        os.mkdir(bin_path)
+        _write(
+            os.path.join(bin_path, "tmux"),
+            TMUX_SHIM.format(
+                count_path=shlex.quote(self._count_path), tmux=shlex.quote(self._tmux)
+            ),
+            0o755,
+        )
+        fake_ssh_path = os.path.join(bin_path, "fake-ssh")
+        _write(
+            fake_ssh_path,
+            FAKE_SSH.format(
+                connect_delay=args.connect_delay,
+                shell_delay=args.shell_delay,
+                password_prompt=args.password_prompt,
+                shell_prompt=args.shell_prompt,
+            ),
+            0o755,
+        )
+
+        self._batches = [int(n) for n in args.hosts.split(",")]
+        info_path = os.path.join(work_path, "login_info")
+        os.mkdir(info_path)
+        _write(
+            os.path.join(info_path, ".base.yaml"),
+            json.dumps(
+                {
+                    "CREDENTIAL": [{"USER": "bench", "PASSWORD": "secret"}],
+                    "PASSWORD_PROMPT": args.password_prompt,
+                    "SHELL_PROMPT": args.shell_prompt,
+                    "PORT": 22,
+                }
+            ),
+        )
+        for n in sorted(set(self._batches)):
+            batch_path = os.path.join(info_path, "b{}".format(n))
+            os.mkdir(batch_path)
+            for i in range(n):
+                _write(
+                    os.path.join(batch_path, "h{:03d}.yaml".format(i)),
+                    "HOST: host{}\n".format(i),
+                )
+
+        config_path = os.path.join(work_path, "config.yaml")
+        _write(
+            config_path,
+            json.dumps(
+                {
+                    "LOGIN_INFO_ROOT_PATH": info_path,
+                    "LOGIN_INFO_SNAPSHOT_ENABLED": False,
+                    "LOG_FILE_PATH": os.path.join(work_path, "slm.log"),
+                    "HISTORY_FILE_PATH": os.path.join(work_path, "history"),
+                    "TMP_BIN_PATH": os.path.join(work_path, "tmp_bin"),
+                    "LOGIN_FORMAT": fake_ssh_path + " {user} {host} {port}",
+                    "TMUX_SOCKET_NAME": self._socket_name,
+                    "TMUX_CONTROL_MODE": args.control_mode == "on",
+                    "MLOGIN_CONCURRENCY": args.concurrency,
+                    "BACKGROUND_LOGIN": False,
+                }
+            ),
+        )
+
+        # the tmux server and shells in panes inherit the environment
+        os.environ.pop("TMUX", None)
+        os.environ["PATH"] = bin_path + os.pathsep + os.environ["PATH"]
+        os.environ["SHELL"] = args.shell
+        # a local prompt must not be taken as the prompt of a host
+        os.environ["PS1"] = "local> "
+        self._manager = Manager(config_path)
+
+    def invocations(self):
+        with open(self._count_path, "r") as fin:
+            return sum(1 for _ in fin)
+
+    def _server_cpu_time(self):
+        """:returns: cpu seconds of the tmux server, or None without /proc"""
+        try:
+            with open("/proc/{}/stat".format(self._server_pid), "r") as fin:
+                fields = fin.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime are the 14th and 15th fields
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def _usage(self):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (
+            self.invocations(),
+            own.ru_utime + own.ru_stime,
+            children.ru_utime + children.ru_stime,
+            self._server_cpu_time(),
+        )
+
+    def measure(self, func):
+        """
+        :func: the operation to measure
+        :returns: (a dict of measurements, return value of func)
+
+        """
+        before = self._usage()
+        begin = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - begin
+        after = self._usage()
+        measurement = {
+            "seconds": elapsed,
+            "tmux_invocations": after[0] - before[0],
+            "cpu_seconds": {
+                "slm": after[1] - before[1],
+                "tmux_clients": after[2] - before[2],
+                "tmux_server": (None if before[3] is None else after[3] - before[3]),
+            },
+        }
+        return measurement, value
+
+    def start(self):
+        """
+        Start the tmux server with the login session, then attach to it and
+        start the control client before measuring.
+        """
+
+        def start():
+            # there is no server on the private socket yet, start it explicitly
+            subprocess.run(
+                [
+                    self._tmux,
+                    "-L",
+                    self._socket_name,
+                    "new-session",
+                    "-d",
+                    "-s",
+                    tmux_util.SESSION_NAME,
+                ],
+                check=True,
+            )
+            tmux_util.get_session()
+            tmux_util.control_client()
+
+        measurement, _ = self.measure(start)
+        self._server_pid = int(
+            tmux_util.run_commands([["display-message", "-p", "#{pid}"]])[0]
+        )
+        return measurement
+
+    def _kill_windows(self, prefix):
+        windows = tmux_util.run_commands(
+            [
+                [
+                    "list-windows",
+                    "-t",
+                    "=%s:" % tmux_util.SESSION_NAME,
+                    "-F",
+                    "#{window_id} #{window_name}",
+                ]
+            ]
+        )
+        commands = []
+        for line in windows:
+            window_id, _, window_name = line.partition(" ")
+            if window_name.startswith(prefix):
+                commands.append(["kill-window", "-t", window_id])
+        if len(commands) > 0:
+            tmux_util.run_commands(commands)
+
+    def _run_command(self, name, *args):
+        clazz = command.load_command_class(name)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            clazz(None, self._manager, self._manager.login_info_manager()).run(args)
+        match = RESULT_RE.search(output.getvalue())
+        if match is None:
+            return {"output": output.getvalue()}
+        return {"succeeded": int(match.group(1)), "failed": int(match.group(2))}
+
+    def run_batch(self, n):
+        batch_id = "b{}".format(n)
+        result = {"hosts": n}
+        result["new_tiled_panes"], panes = self.measure(
+            lambda: tmux_util.new_tiled_panes("panes-" + batch_id, n)
+        )
+        if len(panes) != n:
+            result["new_tiled_panes"]["error"] = "{} panes are created".format(
+                len(panes)
+            )
+        self._kill_windows("panes-" + batch_id)
+
+        measurement, outcome = self.measure(
+            lambda: self._run_command("mlogin", batch_id)
+        )
+        measurement.update(outcome)
+        result["mlogin"] = measurement
+        self._kill_windows(batch_id)
+
+        if n == 1:
+            host_id = batch_id + ".h000.yaml"
+            measurement, outcome = self.measure(
+                lambda: self._run_command("login", host_id)
+            )
+            measurement.update(outcome)
+            result["login"] = measurement
+            self._kill_windows("h000.yaml")
+        return result
+
+    def batches(self):
+        return self._batches
+
+    def close(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self._manager.close()
+        client = tmux_util.control_client()
+        if client is not None:
+            client.close()
+        subprocess.run(
+            [self._tmux, "-L", self._socket_name, "kill-server"],
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark login and mlogin against a private tmux server"
+    )
+    parser.add_argument("--hosts", default="1,10,50,100,200", help="batch sizes")
+    parser.add_argument("--connect-delay", type=float, default=0.05)
+    parser.add_argument("--shell-delay", type=float, default=0.05)
+    parser.add_argument("--password-prompt", default="password:")
+    parser.add_argument("--shell-prompt", default="$")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--control-mode", choices=["on", "off"], default="on")
+    parser.add_argument("--shell", default="/bin/sh", help="shell of panes")
+    parser.add_argument("--socket-name", help="default: slm-benchmark-<pid>")
+    parser.add_argument("--output", help="json file to write, default stdout")
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix="slm-benchmark-")
+    harness = None
+    try:
+        harness = Harness(args, work_path)
+        startup = harness.start()
+        results = []
+        for n in harness.batches():
+            results.append(harness.run_batch(n))
+            print("{} hosts: done".format(n), file=sys.stderr)
+    finally:
+        if harness is not None:
+            harness.close()
+        shutil.rmtree(work_path)
+
+    report = {
+        "benchmark": "tmux_login",
+        "python": platform.python_version(),
+        "params": {
+            k: v for k, v in vars(args).items() if k not in ("output", "socket_name")
+        },
+        "startup": startup,
+        "results": results,
+    }
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(content)
+    else:
+        with open(args.output, "w") as fout:
+            fout.write(content + "\n")
+
+
+if __name__ == "__main__":
+    main()
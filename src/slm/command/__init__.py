@@ -1,18 +1,85 @@
-import os
+"""
+Registry of commands. A command module is only imported when the command is
+used for the first time.
 
-modules = []
+Commands of other packages can be registered by entry points in the group
+`slm.commands`, e.g.
 
-for module in os.listdir(os.path.dirname(__file__)):
-    if module == '__init__.py' or module[-3:] != '.py':
-        continue
-    __import__(__name__ + '.' + module[:-3], locals(), globals())
-    modules.append(module)
+    [options.entry_points]
+    slm.commands =
+        deploy = my_package.deploy_command:DeployCommand
+"""
 
-del module
-del modules
-del os
+import importlib
+import logging
 
-from .base_command import ALL_COMMANDS
-__all__ = ALL_COMMANDS
+logger = logging.getLogger(__name__)
 
-del ALL_COMMANDS
+ENTRY_POINT_GROUP = "slm.commands"
+
+# command name -> "module:class"
+COMMANDS = {
+    "login": "slm.command.login_command:LoginCommand",
+    "mlogin": "slm.command.login_command:MLoginCommand",
+    "ls": "slm.command.ls_command:LsCommand",
+    "show": "slm.command.show_command:ShowCommand",
+    "reload": "slm.command.reload_command:ReloadCommand",
+    "run": "slm.command.run_command:RunCommand",
+    "jobs": "slm.command.jobs_command:JobsCommand",
+    "stats": "slm.command.stats_command:StatsCommand",
+}
+
+_plugin_commands = None
+_command_classes = {}
+
+
+def plugin_commands():
+    """
+    Commands registered by entry points, they are discovered on first call,
+    because scanning installed packages is slow.
+
+    :returns: a dict of command name -> "module:class"
+
+    """
+    global _plugin_commands
+    if _plugin_commands is None:
+        from importlib.metadata import entry_points
+
+        _plugin_commands = {}
+        try:
+            eps = entry_points(group=ENTRY_POINT_GROUP)
+        except TypeError:
+            # python < 3.10
+            eps = entry_points().get(ENTRY_POINT_GROUP, [])
+        for ep in eps:
+            if ep.name in COMMANDS:
+                logger.warning(
+                    "command %s of %s conflicts with a builtin command, ignore it",
+                    ep.name,
+                    ep.value,
+                )
+                continue
+            _plugin_commands[ep.name] = ep.value
+    return _plugin_commands
+
+
+def load_command_class(name):
+    """
+    Import the module of a command and return its class.
+
+    :name: name of the command
+    :returns: a subclass of BaseCommand, or None if there is no such command
+
+    """
+    clazz = _command_classes.get(name)
+    if clazz is not None:
+        return clazz
+    spec = COMMANDS.get(name)
+    if spec is None:
+        spec = plugin_commands().get(name)
+    if spec is None:
+        return None
+    module_name, _, class_name = spec.partition(":")
+    clazz = getattr(importlib.import_module(module_name), class_name)
+    _command_classes[name] = clazz
+    return clazz
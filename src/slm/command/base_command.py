@@ -2,13 +2,6 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-ALL_COMMANDS = []
-
-
-def register_command(clazz):
-    ALL_COMMANDS.append(clazz)
-    return clazz
-
 
 class BaseCommand(object):
     def __init__(self, shell, manager, login_info_manager):
@@ -22,6 +15,13 @@ class BaseCommand(object):
             return cls._name
         raise NotImplemented()
 
+    def split_args(self, arg):
+        """
+        :arg: the line after the command name
+        :returns: arguments passed to run_x
+        """
+        return [] if arg is None else arg.split()
+
     def run(self, args):
         try:
             return self.run_x(*args)
@@ -50,6 +50,7 @@ class BaseCommand(object):
         nodes = self._login_info_manager.search_nodes(text, False)
         results = []
         for id, node in nodes:
-            if node.login_info().host() is not None:
+            # only a node of a file has host, check it without loading login info
+            if not node.is_dir():
                 results.append(id)
         return results
@@ -0,0 +1,71 @@
+import logging
+
+from .base_command import BaseCommand
+
+logger = logging.getLogger(__name__)
+
+
+class JobsCommand(BaseCommand):
+    """
+    Show background jobs of login and mlogin, e.g. `jobs` lists jobs with the
+    phase of every target, `jobs cancel 3` cancels job 3.
+    """
+
+    _name = "jobs"
+    _actions = ["cancel"]
+
+    def run_x(self, *args):
+        if len(args) == 0:
+            self._list_jobs()
+            return
+        if args[0] == "cancel" and len(args) == 2:
+            self._cancel_job(args[1])
+            return
+        print("usage: jobs [cancel <job_id>]")
+
+    def _list_jobs(self):
+        jobs = self._manager.job_manager().jobs()
+        if len(jobs) == 0:
+            print("no jobs")
+            return
+        for job in jobs:
+            print(
+                "[{}] {} {:.1f}s {}".format(
+                    job.id(), job.state(), job.elapsed(), job.name()
+                )
+            )
+            if job.state() in (job.RUNNING, job.CANCELLED):
+                for target_id, phase in job.phases():
+                    print("\t{}: {}".format(target_id, phase))
+            else:
+                for line in job.summary():
+                    print("\t" + line.lstrip("\t"))
+
+    def _cancel_job(self, job_id):
+        job = None
+        if job_id.isdigit():
+            job = self._manager.job_manager().job(int(job_id))
+        if job is None:
+            print("job {} does not exist".format(job_id))
+            return
+        if job.state() != job.RUNNING:
+            print("job {} is {}".format(job_id, job.state()))
+            return
+        job.cancel()
+        print("cancel job {}".format(job_id))
+
+    def complete_x(self, line_parser):
+        if line_parser.cursor_word_idx() == 1:
+            return [
+                action
+                for action in self._actions
+                if action.startswith(line_parser.cursor_word())
+            ]
+        if line_parser.cursor_word_idx() == 2:
+            return [
+                str(job.id())
+                for job in self._manager.job_manager().jobs()
+                if job.state() == job.RUNNING
+                and str(job.id()).startswith(line_parser.cursor_word())
+            ]
+        return []
@@ -1,89 +1,225 @@
+import asyncio
 import base64
-import json
+import copy
 import logging
-import subprocess
+import os
+import re
+import shlex
 import time
 
-from cryptography.hazmat.primitives.twofactor.totp import TOTP
-from cryptography.hazmat.primitives.hashes import SHA1
-
-from .base_command import BaseCommand, register_command
+from .base_command import BaseCommand
 from ..login_info.login_info import Property
+from ..login_info.login_info_manager import LoginChainError
 from ..setting import setting
-from ..util.tmux_util import (
-    new_pane_in_window,
-    wait_until,
-    wait_until_any,
-    new_tiled_panes,
-)
+from ..util.job_manager import Job
+from ..util import ssh_control
+from ..util.secret_cache import credential_key
+from ..util.terminal import TmuxTerminal, create_terminals
+from ..util.tmux_util import new_pane_in_window
 
 logger = logging.getLogger(__name__)
 
+# typed after a hook to print its exit status with a token of the login and
+# the index of the hook, the echoed command line has %s instead of a status
+AFTER_HOOK_STATUS_COMMAND = "printf '\\n__slm_hook_{}_{}_%s\\n' $?"
+AFTER_HOOK_STATUS_PATTERN = r"__slm_hook_{}_{}_(\d+)"
+# prompts of POSIX shells, other shells or device CLIs may not run the status printf
+POSIX_SHELL_PROMPT_SUFFIXES = ("$", "#")
 
-@register_command
-class LoginCommand(BaseCommand):
-    _name = "login"
 
-    def _login(self, pane, node, login_format, exit):
-        def fetch_secrets(credential):
-            hook = credential.get("SECRETS_HOOK")
-            if hook is None:
-                return (credential.get("PASSWORD"), None)
-            else:
-                if isinstance(hook, str):
-                    process = subprocess.run(
-                        hook,
-                        shell=True,
-                        check=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                    )
-                elif isinstance(hook, list):
-                    process = subprocess.run(
-                        hook,
-                        check=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                    )
-                else:
-                    raise Exception("unknown type of `SECRETS_HOOK`")
-                output = str(process.stdout, "utf8")
-                secrets = json.loads(output)
-                return (secrets.get("PASSWORD"), secrets.get("OTP_OPTIONS"))
+def _ignore_progress(phase):
+    pass
+
+
+class Hop(object):
+    """
+    A hop of a login chain with everything needed to login it. Values are
+    copied from login info while planning, so a background job doesn't read
+    login info, which may be reloaded by the shell meanwhile.
+    """
 
+    __slots__ = (
+        "id",
+        "host",
+        "port",
+        "credential",
+        "password_prompt",
+        "shell_prompt",
+        "otp_prompt",
+        "auto_exit",
+        "next_login_format",
+        "after_hooks",
+    )
+
+    def __init__(self, node, credential):
+        """
+        :node: node of the hop
+        :credential: the selected credential of the node
+        """
         login_info = node.login_info()
-        credential = login_info.credential(is_raw=True)
+        self.id = node.id()
+        self.host = login_info.host()
+        self.port = login_info.port()
+        self.credential = copy.deepcopy(credential)
+        self.password_prompt = login_info.password_prompt()
+        self.shell_prompt = login_info.shell_prompt()
+        self.otp_prompt = login_info.otp_prompt()
+        self.auto_exit = bool(login_info.auto_exit_enabled())
+        self.next_login_format = login_info.next_login_format()
+        after_hooks = login_info.after_hooks()
+        self.after_hooks = (
+            [str(hook) for hook in after_hooks]
+            if isinstance(after_hooks, list)
+            else None
+        )
+
+
+class _PhaseTracker(object):
+    """
+    Track phases of logging in a target. Entering a phase reports it as the
+    progress of the job, and records the time spent in the previous phase.
+    """
+
+    def __init__(self, hops, stats, progress=_ignore_progress):
+        """
+        :hops: a list of Hop, the last one is the target
+        :stats: LoginStats to record time of phases
+        :progress: a function to report the current phase
+        """
+        self._target_id = hops[-1].id
+        self._bastion_id = hops[0].id if len(hops) > 1 else None
+        self._stats = stats
+        self._progress = progress
+        self._begin = time.monotonic()
+        # (phase, host id, begin)
+        self._phase = None
+
+    def enter(self, phase, hop=None):
+        """
+        :phase: name of the phase
+        :hop: the hop logged in during the phase, the target if it is None
+        """
+        now = time.monotonic()
+        self._end_phase(now)
+        host_id = self._target_id if hop is None else hop.id
+        self._phase = (phase, host_id, now)
+        self._progress(phase if hop is None else phase + " " + host_id)
+
+    def finish(self, phase):
+        """:phase: the last phase reported as progress, e.g. done or failed"""
+        now = time.monotonic()
+        self._end_phase(now)
+        self._phase = None
+        self._stats.record(
+            "total", self._target_id, self._bastion_id, now - self._begin
+        )
+        self._progress(phase)
+
+    def _end_phase(self, now):
+        if self._phase is None:
+            return
+        phase, host_id, begin = self._phase
+        # the bastion itself is not reached through a bastion
+        bastion_id = None if host_id == self._bastion_id else self._bastion_id
+        self._stats.record(phase, host_id, bastion_id, now - begin)
+
+
+class LoginResult(object):
+    def __init__(self, target):
+        # Hop of the target
+        self.target = target
+        self.succeeded = False
+        # the Hop which failed
+        self.failed_hop = None
+        self.reason = None
+        # exit status of the command run after login
+        self.exit_status = None
+        # problems which don't fail the login, like failed after hooks
+        self.warnings = []
+
+    def fail(self, hop, reason):
+        self.succeeded = False
+        self.failed_hop = hop
+        self.reason = reason
+        return self
+
+
+class LoginCommand(BaseCommand):
+    _name = "login"
+
+    def _select_credential(self, node):
+        """
+        Select a credential of a node, the user may be asked to choose one,
+        so it must be done before logging in concurrently.
+        """
+        credential = node.login_info().credential(is_raw=True)
         if credential == Property.NONE_PROPERTY:
-            print("no credential found for {}".format(node.id()))
-            return False
+            return None
         if (
             self._credential_index is not None
             and len(credential.values()) > self._credential_index
         ):
-            credential = credential.values()[self._credential_index]
-        else:
-            credential = credential.select_one(node, "USER")
+            return credential.values()[self._credential_index]
+        return credential.select_one(node, "USER")
+
+    def _plan(self, node):
+        """
+        Resolve the login chain of a node and the credential of every hop.
+        It must be called with the lock of the manager held.
+
+        :node: target node
+        :returns: a list of Hop, or None if a credential is missing
+
+        """
+        try:
+            chain_nodes = self._login_info_manager.login_chain(node)
+        except LoginChainError as e:
+            print(e)
+            return None
+        warning = self._login_info_manager.previous_login_warning(chain_nodes[0])
+        if warning is not None:
+            print(warning)
+        hops = []
+        for chain_node in chain_nodes:
+            credential = self._select_credential(chain_node)
+            if credential is None:
+                print("no credential found for {}".format(chain_node.id()))
+                return None
+            hops.append(Hop(chain_node, credential))
+        return hops
+
+    async def _login(self, terminal, hop, login_format, tracker):
+        loop = asyncio.get_running_loop()
         login_command = login_format.format(
-            user=credential.get("USER"), host=login_info.host(), port=login_info.port()
+            user=hop.credential.get("USER"), host=hop.host, port=hop.port
         )
-        if exit:
+        if hop.auto_exit:
             login_command += "; exit"
         logger.debug("login_command: %s", login_command)
-        pane.send_keys(login_command)
+        await terminal.send_keys(login_command)
         # Multiple ssh sessions can share one connection. In this case, there is no need to enter password
-        encouter_prompt = wait_until_any(
-            pane, [login_info.password_prompt(), login_info.shell_prompt()], 60
+        encouter_prompt = await terminal.wait_until_any(
+            [hop.password_prompt, hop.shell_prompt], 60
         )
         if encouter_prompt is None:
             return False
-        if encouter_prompt == login_info.shell_prompt():
+        if encouter_prompt == hop.shell_prompt:
             return True
-        password, otp_options = fetch_secrets(credential)
-        pane.send_keys(password, suppress_history=False)
+        tracker.enter("secrets", hop)
+        password, otp_options = await loop.run_in_executor(
+            None, self._manager.secret_cache().get, hop.credential
+        )
+        tracker.enter("password", hop)
+        await terminal.send_keys(password, suppress_history=False)
         # if otp is enabled
-        if login_info.otp_prompt() is not None:
-            if not wait_until(pane, login_info.otp_prompt(), 60):
+        if hop.otp_prompt is not None:
+            if not await terminal.wait_until(hop.otp_prompt, 60):
                 return False
+            tracker.enter("otp", hop)
+            # cryptography is slow to import, only import it when otp is used
+            from cryptography.hazmat.primitives.twofactor.totp import TOTP
+            from cryptography.hazmat.primitives.hashes import SHA1
+
             totp = TOTP(
                 base64.b32decode(otp_options["SECRET"]),
                 otp_options.get("LENGTH", 6),
@@ -92,66 +228,159 @@ class LoginCommand(BaseCommand):
                 enforce_key_length=False,
             )
             otp_password = str(totp.generate(time.time()), "utf8")
-            pane.send_keys(otp_password, suppress_history=False)
-        result = wait_until(pane, login_info.shell_prompt(), 60)
+            await terminal.send_keys(otp_password, suppress_history=False)
+        result = await terminal.wait_until(hop.shell_prompt, 60)
         return result
 
-    def _run_shell_command(self, pane, command, shell_prompt, waiting):
-        pane.send_keys(command)
-        if waiting:
-            result = wait_until(pane, shell_prompt, 60)
-        else:
-            result = True
-        return result
+    def _first_login_format(self, control_path):
+        """
+        LOGIN_FORMAT with ControlMaster options, so logins to the same first
+        hop reuse one authenticated connection.
 
-    def _chain_login(self, nodes, pane):
-        target_node = nodes[-1]
-        pane.send_keys("clear")
+        :control_path: ControlPath of master connections, None to not share them
+        """
         login_format = setting.LOGIN_FORMAT
-        result = False
-        for node in nodes:
-            try:
-                exit = (
-                    node.login_info().auto_exit_enabled() is not None
-                    and node.login_info().auto_exit_enabled()
+        if control_path is None:
+            return login_format
+        options = "-o ControlMaster=auto -o ControlPath={} -o ControlPersist={}".format(
+            shlex.quote(control_path), setting.SSH_CONTROL_PERSIST
+        )
+        words = login_format.split(None, 1)
+        words.insert(1, options)
+        return " ".join(words)
+
+    async def _chain_login(
+        self, hops, terminal, tracker, first_hop_done=None, control_path=None
+    ):
+        """
+        Login hop by hop in a terminal, then run after hooks of the target.
+
+        :hops: a list of Hop, the last one is the target
+        :terminal: terminal to login
+        :tracker: a _PhaseTracker of the target
+        :first_hop_done: an asyncio.Event to set after logging in the first hop
+        :control_path: ControlPath of ssh master connections, or None
+        :returns: a LoginResult
+
+        """
+        target = hops[-1]
+        login_result = LoginResult(target)
+        try:
+            await terminal.clear()
+            login_format = self._first_login_format(control_path)
+            for hop in hops:
+                try:
+                    tracker.enter("connecting", hop)
+                    result = await self._login(terminal, hop, login_format, tracker)
+                except Exception as e:
+                    logger.warn("unknow error", exc_info=True)
+                    return login_result.fail(hop, str(e))
+                if not result:
+                    logger.info("login %s failed", hop.id)
+                    return login_result.fail(hop, "timeout")
+                if first_hop_done is not None:
+                    first_hop_done.set()
+                login_format = hop.next_login_format
+        finally:
+            # let followers go on even if it fails, they will login by themselves
+            if first_hop_done is not None:
+                first_hop_done.set()
+        login_result.succeeded = True
+        if target.after_hooks:
+            tracker.enter("hooks")
+            login_result.warnings.extend(await self._run_after_hooks(terminal, target))
+        return login_result
+
+    async def _run_after_hooks(self, terminal, hop):
+        """
+        Type after hooks line by line, every hook is followed by a line
+        printing its exit status, which is waited before the next hook. Hooks
+        are not wrapped, so a hook may switch shells, e.g. `sudo su -`, or end
+        with a comment. If the shell prompt is not one of a POSIX shell, wait
+        for the prompt printed after every hook instead, its status is
+        unknown. The last hook is not waited, it may not return, e.g.
+        `tail -f`.
+
+        :returns: messages of hooks which failed or are not finished in time
+        """
+        after_hooks = hop.after_hooks
+        errors = []
+        shell_prompt = hop.shell_prompt
+        posix = shell_prompt is None or str(shell_prompt).strip().endswith(
+            POSIX_SHELL_PROMPT_SUFFIXES
+        )
+        # tells status lines of this login from ones left in the terminal
+        token = os.urandom(4).hex()
+        for index, hook in enumerate(after_hooks[:-1]):
+            if not posix:
+                if not await terminal.send_keys_until_prompt(hook, shell_prompt, 60):
+                    errors.append(
+                        "run {} failed after login {}: timeout".format(hook, hop.id)
+                    )
+                    return errors
+                continue
+            await terminal.send_keys(hook)
+            match = await terminal.send_keys_until_line(
+                AFTER_HOOK_STATUS_COMMAND.format(token, index),
+                re.compile(AFTER_HOOK_STATUS_PATTERN.format(token, index)),
+                60,
+            )
+            if match is None:
+                errors.append(
+                    "run {} failed after login {}: timeout".format(hook, hop.id)
                 )
-                result = self._login(pane, node, login_format, exit)
-            except Exception:
-                logger.warn("unknow error", exc_info=True)
-                result = False
-            if not result:
-                print("login {} failed".format(node.id()))
-                logger.info("login %s failed", node.id())
-                return result
-            login_format = node.login_info().next_login_format()
-        after_hooks = target_node.login_info().after_hooks()
-        if after_hooks is not None and isinstance(after_hooks, list):
-            shell_prompt = target_node.login_info().shell_prompt()
-            count = 1
-            for command in after_hooks:
-                hook_result = self._run_shell_command(
-                    pane, command, shell_prompt, count < len(after_hooks)
+                return errors
+            if match.group(1) != "0":
+                errors.append(
+                    "run {} failed after login {}: exit status {}".format(
+                        hook, hop.id, match.group(1)
+                    )
                 )
-                count += 1
-                if not hook_result:
-                    print("run {} failed after login".format(command))
-                    break
-        return result
+        await terminal.send_keys(after_hooks[-1])
+        return errors
 
     def login(self, node, pane):
-        chain_nodes = [node]
-        previous_login = node.login_info().previous_login()
-        while previous_login is not None:
-            nodes = self._login_info_manager.nodes_by_name(previous_login)
-            if nodes is not None:
-                # TODO prompt to let user select
-                previous_login = nodes[0].login_info().previous_login()
-                chain_nodes.append(nodes[0])
-            else:
-                previous_login = None
-
-        chain_nodes.reverse()
-        self._chain_login(chain_nodes, pane)
+        hops = self._plan(node)
+        if hops is None:
+            return
+        self._start("login " + node.id(), [hops], [TmuxTerminal(pane)])
+
+    def _start(self, name, plans, terminals):
+        """
+        Login as a background job if BACKGROUND_LOGIN is enabled, see `jobs`.
+        Or else wait for it and print results.
+
+        :name: name of the job
+        :plans: hops of every target
+        :terminals: a terminal for every target
+
+        """
+        credentials = [hop.credential for hops in plans for hop in hops]
+        # it may print a warning, so it is resolved in the shell, not in a job
+        control_path = ssh_control.control_path()
+
+        async def login(job):
+            loop = asyncio.get_running_loop()
+            begin = time.monotonic()
+            # fetch secrets of all credentials by one call if a batch hook is set
+            await loop.run_in_executor(
+                None,
+                self._manager.secret_cache().prefetch,
+                credentials,
+            )
+            results = await self._login_all(
+                plans, terminals, job=job, control_path=control_path
+            )
+            return self._format_results(results, time.monotonic() - begin)
+
+        if setting.BACKGROUND_LOGIN:
+            job = self._manager.job_manager().submit(
+                name, [hops[-1].id for hops in plans], login
+            )
+            print("[{}] {}".format(job.id(), job.name()))
+        else:
+            for line in asyncio.run(login(None)):
+                print(line)
 
     def run_x(self, node_id, *args):
         node = self._login_info_manager.node(node_id)
@@ -168,17 +397,131 @@ class LoginCommand(BaseCommand):
         # TODO to solve window name conllision
         # find pane for login
         name = node.name()
+        begin = time.monotonic()
         pane = new_pane_in_window(name)
+        self._manager.login_stats().record(
+            "panes", node.id(), None, time.monotonic() - begin
+        )
 
         self.login(node, pane)
 
+    async def _login_all(
+        self, plans, terminals, after_login=None, job=None, control_path=None
+    ):
+        """
+        Login all terminals concurrently, at most MLOGIN_CONCURRENCY at the same time.
+
+        :plans: hops of every target
+        :terminals: a terminal for every target
+        :after_login: a coroutine function called with (hops, terminal, result) after logging in successfully
+        :job: a Job to report the phase of every target to
+        :control_path: ControlPath of ssh master connections from
+            ssh_control.control_path(), resolved by the caller in the shell
+            thread, or None to not share them
+        :returns: a list of LoginResult in the order of plans, a failure of
+            one target doesn't stop others
+
+        """
+        semaphore = asyncio.Semaphore(max(1, setting.MLOGIN_CONCURRENCY))
+
+        # e.g. tmux failed to split a pane, targets without terminals fail
+        missing_results = []
+        if len(terminals) < len(plans):
+            logger.warning(
+                "%d terminals are created for %d targets", len(terminals), len(plans)
+            )
+            for hops in plans[len(terminals) :]:
+                missing_results.append(
+                    LoginResult(hops[-1]).fail(hops[0], "no terminal to login")
+                )
+                if job is not None:
+                    job.progress(hops[-1].id)(Job.FAILED_PHASE)
+            plans = plans[: len(terminals)]
+
+        # plans sharing the same first hop: the first one logs in and creates
+        # the master connection, others wait for it and reuse the connection
+        first_hop_events = {}
+        waiting_events = []
+        for hops in plans:
+            event = None
+            if control_path is not None:
+                key = (hops[0].id, credential_key(hops[0].credential))
+                event = first_hop_events.get(key)
+                if event is None:
+                    first_hop_events[key] = asyncio.Event()
+                    waiting_events.append((first_hop_events[key], None))
+                    continue
+            waiting_events.append((None, event))
+
+        async def login_one(hops, terminal, first_hop_done, leader_done):
+            progress = _ignore_progress
+            if job is not None:
+                progress = job.progress(hops[-1].id)
+            tracker = _PhaseTracker(hops, self._manager.login_stats(), progress)
+            tracker.enter("queued")
+            if leader_done is not None:
+                await leader_done.wait()
+            result = None
+            try:
+                async with semaphore:
+                    tracker.enter("opening")
+                    await terminal.open()
+                    await terminal.select()
+                    result = await self._chain_login(
+                        hops, terminal, tracker, first_hop_done, control_path
+                    )
+                    tracker.finish(
+                        Job.DONE_PHASE if result.succeeded else Job.FAILED_PHASE
+                    )
+                    if after_login is not None and result.succeeded:
+                        await after_login(hops, terminal, result)
+                    return result
+            except Exception as e:
+                logger.warning("login %s failed", hops[-1].id, exc_info=True)
+                if result is None:
+                    tracker.finish(Job.FAILED_PHASE)
+                    result = LoginResult(hops[-1])
+                return result.fail(hops[-1], str(e))
+            finally:
+                # followers wait for it, even if it fails before logging in
+                if first_hop_done is not None:
+                    first_hop_done.set()
+
+        results = await asyncio.gather(
+            *[
+                login_one(hops, terminal, first_hop_done, leader_done)
+                for hops, terminal, (first_hop_done, leader_done) in zip(
+                    plans, terminals, waiting_events
+                )
+            ]
+        )
+        return results + missing_results
+
+    def _format_results(self, results, elapsed):
+        """:returns: lines to describe results of logging in"""
+        failed_results = [result for result in results if not result.succeeded]
+        lines = [
+            "login finished in {:.1f}s: {} succeeded, {} failed".format(
+                elapsed, len(results) - len(failed_results), len(failed_results)
+            )
+        ]
+        for result in failed_results:
+            lines.append(
+                "\t{}: failed at {}, {}".format(
+                    result.target.id, result.failed_hop.id, result.reason
+                )
+            )
+        for result in results:
+            for warning in result.warnings:
+                lines.append("\t" + warning)
+        return lines
+
     def complete_x(self, line_parser):
         if line_parser.cursor_word_idx() != 1:
             return []
         return self.complete_node(line_parser.cursor_word())
 
 
-@register_command
 class MLoginCommand(LoginCommand):
     """
     Login to multiple nodes of one parent node. It will always open new windows to login.
@@ -195,19 +538,7 @@ class MLoginCommand(LoginCommand):
         :returns: sub nodes which has host
 
         """
-        sub_nodes = []
-        sub_nodes_with_host = []
-        if parent_node.has_child():
-            sub_nodes.extend(parent_node.children())
-        for sub_node in sub_nodes:
-            if (
-                sub_node.login_info().host() is not None
-                and not sub_node.login_info().no_batch()
-            ):
-                sub_nodes_with_host.append(sub_node)
-            if sub_node.has_child():
-                sub_nodes.extend(sub_node.children())
-        return sub_nodes_with_host
+        return list(self._login_info_manager.batch_nodes(parent_node))
 
     def run_x(self, node_id, *args):
         node = self._login_info_manager.node(node_id)
@@ -221,13 +552,22 @@ class MLoginCommand(LoginCommand):
         if len(args) > 0:
             self._credential_index = int(args[0])
 
-        # create tiled panes for login
-        panes = new_tiled_panes(node_id, len(sub_nodes))
+        # credentials may be chosen by the user, select them before logging in
+        plans = []
+        for sub_node in sub_nodes:
+            hops = self._plan(sub_node)
+            if hops is not None:
+                plans.append(hops)
+        if len(plans) == 0:
+            return
 
-        for idx in range(0, len(sub_nodes)):
-            pane = panes[idx]
-            pane.select_pane()
-            self.login(sub_nodes[idx], pane)
+        # create tiled panes for login
+        begin = time.monotonic()
+        terminals = create_terminals("tmux", node_id, len(plans))
+        self._manager.login_stats().record(
+            "panes", node_id, None, time.monotonic() - begin
+        )
+        self._start("mlogin " + node_id, plans, terminals)
 
     def complete_x(self, line_parser):
         if line_parser.cursor_word_idx() != 1:
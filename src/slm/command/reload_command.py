@@ -1,11 +1,10 @@
 import logging
 
-from .base_command import BaseCommand, register_command
+from .base_command import BaseCommand
 
 logger = logging.getLogger(__name__)
 
 
-@register_command
 class ReloadCommand(BaseCommand):
     _name = "reload"
 
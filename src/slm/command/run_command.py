@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import re
+import time
+
+from .login_command import MLoginCommand
+from ..setting import setting
+from ..util import ssh_control
+from ..util.tmux_control import ESCAPE_SEQUENCE_RE
+from ..util.terminal import create_terminals
+
+logger = logging.getLogger(__name__)
+
+# quotes split the marker, so the echoed command line doesn't match it
+EXIT_STATUS_COMMAND = "printf '__SLM_RUN''_DONE__:%s\\n' $?"
+EXIT_STATUS_ECHO = "__SLM_RUN''_DONE__"
+EXIT_STATUS_RE = re.compile(r"__SLM_RUN_DONE__:(\d+)")
+READY_COMMAND = "printf '__SLM_RUN''_READY__\\n'"
+READY_RE = re.compile(r"__SLM_RUN_READY__")
+
+
+class _OutputPrinter(object):
+    """print output of a command line by line with a prefix"""
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._buffer = ""
+        # output before the command line echoed by the terminal is ignored,
+        # e.g. output of the last after hook which is not waited
+        self._echoed = False
+        self.exit_status = None
+
+    def feed(self, text):
+        """
+        :text: a chunk of output
+        :returns: True if the command is finished
+
+        """
+        if self.exit_status is not None:
+            return True
+        self._buffer += text
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            line = ESCAPE_SEQUENCE_RE.sub("", line).rstrip("\r")
+            # text after a carriage return overwrites the line
+            line = line.rsplit("\r", 1)[-1]
+            if not self._echoed:
+                self._echoed = EXIT_STATUS_ECHO in line
+                continue
+            match = EXIT_STATUS_RE.search(line)
+            if match is not None:
+                # output without a trailing newline is followed by the marker
+                if match.start() > 0:
+                    print(self._prefix + line[: match.start()])
+                self.exit_status = int(match.group(1))
+                return True
+            print(self._prefix + line)
+        return False
+
+
+class RunCommand(MLoginCommand):
+    """
+    Run a command on a node, or on all nodes of a parent node, e.g.
+    `run dc1.web uptime`. Output is printed with node ids as it arrives.
+    The command is run in pseudo terminals without tmux by default, set
+    RUN_BACKEND to tmux to run it in panes.
+    """
+
+    _name = "run"
+
+    def split_args(self, arg):
+        # the command is typed as it is, quotes and spaces are kept
+        return [] if arg is None else arg.split(None, 1)
+
+    def run_x(self, node_id, command=None):
+        if command is None:
+            print("usage: run <node_id> <command>")
+            return
+        node = self._login_info_manager.node(node_id)
+        if node is None:
+            print(f"{node_id} does not exist")
+            return
+        sub_nodes = self._find_all_sub_nodes_with_host(node)
+        if node.login_info().host() is not None:
+            sub_nodes.insert(0, node)
+        self._credential_index = None
+
+        plans = []
+        for sub_node in sub_nodes:
+            hops = self._plan(sub_node)
+            if hops is not None:
+                plans.append(hops)
+        if len(plans) == 0:
+            print(f"there is no host in {node_id}")
+            return
+
+        self._prefix_width = max(len(hops[-1].id) for hops in plans)
+        control_path = ssh_control.control_path()
+
+        async def after_login(hops, terminal, result):
+            await self._run_command(terminal, command, result)
+
+        async def run_all():
+            try:
+                return await self._login_all(
+                    plans, terminals, after_login, control_path=control_path
+                )
+            finally:
+                for terminal in terminals:
+                    await terminal.close()
+
+        # plans don't refer to login info, let it be reloaded while running
+        with self._manager.unlocked():
+            self._manager.secret_cache().prefetch(
+                [hop.credential for hops in plans for hop in hops]
+            )
+            terminals = create_terminals(
+                setting.RUN_BACKEND, "run-" + node_id, len(plans)
+            )
+            begin = time.monotonic()
+            results = asyncio.run(run_all())
+        self._print_exit_status(results, time.monotonic() - begin)
+
+    async def _run_command(self, terminal, command, result):
+        """
+        Run a command in a logged in terminal and print its output.
+
+        :terminal: terminal of the node
+        :command: command to run
+        :result: LoginResult of the node, exit status is set to it
+
+        """
+        loop = asyncio.get_running_loop()
+        # wait for the last after hook, it is not waited after login
+        if await terminal.send_keys_until_line(READY_COMMAND, READY_RE, 60) is None:
+            result.reason = "shell is not ready"
+            return
+        # keys typed before the prompt are echoed before it, then the prompt
+        # would be taken as output of the command
+        if not await terminal.wait_until(result.target.shell_prompt, 60):
+            result.reason = "shell is not ready"
+            return
+        printer = _OutputPrinter(
+            "{:<{}} | ".format(result.target.id, self._prefix_width)
+        )
+        finished = loop.create_future()
+
+        def feed(text):
+            if printer.feed(text) and not finished.done():
+                finished.set_result(None)
+
+        remove_listener = await terminal.add_output_listener(feed)
+        try:
+            await terminal.send_keys(command + "; " + EXIT_STATUS_COMMAND)
+            if remove_listener is None:
+                await self._poll_output(terminal, printer)
+            else:
+                await asyncio.wait_for(finished, setting.RUN_TIMEOUT)
+        except asyncio.TimeoutError:
+            result.reason = "timeout"
+        finally:
+            if remove_listener is not None:
+                remove_listener()
+        result.exit_status = printer.exit_status
+
+    async def _poll_output(self, terminal, printer):
+        """print output captured from a terminal after the command is finished"""
+        deadline = time.monotonic() + setting.RUN_TIMEOUT
+        while True:
+            lines = await terminal.capture()
+            for end in range(len(lines) - 1, -1, -1):
+                if EXIT_STATUS_RE.search(lines[end]) is None:
+                    continue
+                begin = end
+                while begin > 0 and EXIT_STATUS_ECHO not in lines[begin]:
+                    begin -= 1
+                printer.feed("\n".join(lines[begin : end + 1]) + "\n")
+                return
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(0.5)
+
+    def _print_exit_status(self, results, elapsed):
+        failed_results = [result for result in results if result.exit_status != 0]
+        print(
+            "run finished in {:.1f}s: {} succeeded, {} failed".format(
+                elapsed, len(results) - len(failed_results), len(failed_results)
+            )
+        )
+        for result in failed_results:
+            if not result.succeeded:
+                print(
+                    "\t{}: login failed at {}, {}".format(
+                        result.target.id, result.failed_hop.id, result.reason
+                    )
+                )
+            elif result.exit_status is None:
+                print("\t{}: {}".format(result.target.id, result.reason))
+            else:
+                print(
+                    "\t{}: exit status {}".format(result.target.id, result.exit_status)
+                )
+        for result in results:
+            for warning in result.warnings:
+                print("\t" + warning)
+
+    def complete_x(self, line_parser):
+        if line_parser.cursor_word_idx() != 1:
+            return []
+        return self._login_info_manager.search_nodes(line_parser.cursor_word())
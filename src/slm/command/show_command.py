@@ -1,16 +1,21 @@
 import logging
 
-from .base_command import BaseCommand, register_command
+from .base_command import BaseCommand
 from ..login_info import login_info
 
 logger = logging.getLogger(__name__)
 
 
-@register_command
 class ShowCommand(BaseCommand):
     _name = "show"
+    # only properties wrapped by `heritable` can be shown
     _fields = sorted(
-        [field for field in dir(login_info.LoginInfo) if not field.startswith("_")]
+        [
+            field
+            for field in dir(login_info.LoginInfo)
+            if not field.startswith("_")
+            and hasattr(getattr(login_info.LoginInfo, field), "__wrapped__")
+        ]
     )
 
     def run_x(self, node_id, field, *args):
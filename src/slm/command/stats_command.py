@@ -0,0 +1,61 @@
+import logging
+
+from .base_command import BaseCommand
+
+logger = logging.getLogger(__name__)
+
+
+class StatsCommand(BaseCommand):
+    """
+    Show p50/p95/max of time spent in every phase of recent logins, e.g.
+    `stats`, `stats host` or `stats bastion`. Phases are: panes, queued,
+    opening, connecting (waiting for the password prompt), secrets, password
+    (waiting for the OTP or shell prompt), otp, hooks and total.
+    """
+
+    _name = "stats"
+    _group_bys = ["phase", "host", "bastion"]
+
+    def run_x(self, group_by="phase", *args):
+        if group_by not in self._group_bys:
+            print("usage: stats [{}]".format("|".join(self._group_bys)))
+            return
+        rows = self._manager.login_stats().summary(
+            None if group_by == "phase" else group_by
+        )
+        if len(rows) == 0:
+            if group_by == "bastion":
+                print("no login through a bastion is recorded")
+            else:
+                print("no login is recorded")
+            return
+        header = ["phase", "count", "p50", "p95", "max"]
+        lines = [
+            [phase, str(count)] + ["{:.3f}s".format(v) for v in (p50, p95, max_)]
+            for _, phase, count, p50, p95, max_ in rows
+        ]
+        if group_by != "phase":
+            header.insert(0, group_by)
+            for line, row in zip(lines, rows):
+                line.insert(0, row[0])
+        widths = [
+            max(len(line[idx]) for line in [header] + lines)
+            for idx in range(len(header))
+        ]
+        for line in [header] + lines:
+            print(
+                "  ".join(
+                    # texts are aligned left, numbers are aligned right
+                    word.ljust(width) if idx < len(header) - 4 else word.rjust(width)
+                    for idx, (word, width) in enumerate(zip(line, widths))
+                )
+            )
+
+    def complete_x(self, line_parser):
+        if line_parser.cursor_word_idx() != 1:
+            return []
+        return [
+            group_by
+            for group_by in self._group_bys
+            if group_by.startswith(line_parser.cursor_word())
+        ]
@@ -0,0 +1,573 @@
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import time
+
+from .login_info import LoginInfoNode
+from .login_info_manager import LoginInfoManager, ReloadResult
+from .search_index import TrigramIndex
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SLMINV\0\0"
+VERSION = 3
+
+# magic, version, number of records, signature of the tree, offsets and sizes of sections
+HEADER = struct.Struct("<8sII20s7Q")
+# parent, end of subtree, id, name, file name, config, flags
+RECORD = struct.Struct("<iIIIIIIIIIB")
+UINT32 = struct.Struct("<I")
+
+FLAG_DIR = 1
+
+
+class InventoryException(Exception):
+    pass
+
+
+class _StringTable(object):
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = {}
+
+    def add(self, value):
+        """add bytes to the table, same values are stored only once"""
+        if value is None or len(value) == 0:
+            return (0, 0)
+        offset = self._offsets.get(value)
+        if offset is None:
+            offset = len(self._data)
+            self._data.extend(value)
+            self._offsets[value] = offset
+        return (offset, len(value))
+
+    def data(self):
+        return bytes(self._data)
+
+
+def _encode(value):
+    return None if value is None else value.encode("utf8")
+
+
+def tree_signature(root_path):
+    """
+    A digest of paths, mtimes and sizes of all config files under the root
+    path, it changes if a file is added, removed or edited, even in place.
+    It stats every file, so it costs about as much as walking the tree.
+
+    :root_path: root path of login info
+    :returns: 20 bytes
+
+    """
+    digest = hashlib.sha1()
+    pending = [root_path]
+    while len(pending) > 0:
+        path = pending.pop()
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.name.startswith(".") and entry.name != LoginInfoNode.NODE_CONF:
+                continue
+            if entry.is_dir():
+                pending.append(entry.path)
+                continue
+            stat = entry.stat()
+            digest.update(
+                "{}\0{}\0{}\n".format(
+                    os.path.relpath(entry.path, root_path),
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ).encode("utf8", "surrogateescape")
+            )
+    return digest.digest()
+
+
+def compile_inventory(login_info_manager, path, signature=b""):
+    """
+    Compile all nodes of a login info manager into an inventory file, it is
+    written atomically.
+
+    Layout: a header, a string table, fixed-width node records in pre-order,
+    a blob of sorted ids separated by newlines, record indexes in the order
+    of ids and record indexes in the order of names.
+
+    Configs are parsed by node_config once for every node, so a lazy
+    manager, which doesn't parse them while walking, should be given.
+
+    :login_info_manager: a LoginInfoManager
+    :path: path of the inventory file
+    :signature: tree_signature of the root path taken before loading it
+    """
+    nodes = []
+    stack = [login_info_manager.root_node()]
+    while len(stack) > 0:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.children()))
+    indexes = {id(node): idx for idx, node in enumerate(nodes)}
+
+    # the subtree of a node ends at the first later node which isn't its descendant
+    subtree_ends = [len(nodes)] * len(nodes)
+    ancestors = []
+    for idx, node in enumerate(nodes):
+        parent_idx = indexes.get(id(node.parent()))
+        while len(ancestors) > 0 and ancestors[-1] != parent_idx:
+            subtree_ends[ancestors.pop()] = idx
+        ancestors.append(idx)
+
+    sorted_ids = sorted(node.id() for node in nodes[1:])
+    ids_blob = bytearray()
+    id_offsets = {}
+    for node_id in sorted_ids:
+        id_offsets[node_id] = len(ids_blob)
+        ids_blob.extend(node_id.encode("utf8"))
+        ids_blob.extend(b"\n")
+
+    strings = _StringTable()
+    root_path_ref = strings.add(_encode(nodes[0].path()))
+    records = bytearray()
+    for idx, node in enumerate(nodes):
+        parent_idx = indexes.get(id(node.parent()), -1)
+        if node.id() is None:
+            id_ref = (0, 0)
+        else:
+            id_ref = (id_offsets[node.id()], len(node.id().encode("utf8")))
+        name_ref = strings.add(_encode(node.name()))
+        file_name_ref = (
+            root_path_ref if idx == 0 else strings.add(_encode(node.file_name()))
+        )
+        config = login_info_manager.node_config(node)
+        config_ref = (0, 0)
+        if config is not None:
+            config_ref = strings.add(
+                pickle.dumps(config, protocol=pickle.HIGHEST_PROTOCOL)
+            )
+        records.extend(
+            RECORD.pack(
+                parent_idx,
+                subtree_ends[idx],
+                *id_ref,
+                *name_ref,
+                *file_name_ref,
+                *config_ref,
+                FLAG_DIR if node.is_dir() else 0,
+            )
+        )
+
+    idx_by_id = {node.id(): idx for idx, node in enumerate(nodes)}
+    id_sorted_table = bytearray()
+    for node_id in sorted_ids:
+        id_sorted_table.extend(UINT32.pack(idx_by_id[node_id]))
+    name_sorted_table = bytearray()
+    # nodes of the same name are in post-order like LoginInfoManager.nodes_by_name,
+    # a node comes after its descendants and before the nodes after its subtree
+    for idx in sorted(
+        range(1, len(nodes)),
+        key=lambda idx: (nodes[idx].name(), subtree_ends[idx], -idx),
+    ):
+        name_sorted_table.extend(UINT32.pack(idx))
+
+    strings_data = strings.data()
+    sections = [strings_data, records, ids_blob, id_sorted_table]
+    offset = HEADER.size
+    offsets = []
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        len(nodes),
+        signature,
+        offsets[0],
+        len(strings_data),
+        offsets[1],
+        offsets[2],
+        len(ids_blob),
+        offsets[3],
+        offset,
+    )
+
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".{}.".format(os.path.basename(path)), dir=os.path.dirname(path)
+    )
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(header)
+            for section in sections:
+                fout.write(section)
+            fout.write(name_sorted_table)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class _Uint32Table(object):
+    """a read only sequence of uint32 in a mapping, it can be bisected"""
+
+    def __init__(self, buf, offset, length):
+        self._buf = buf
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= self._length:
+            raise IndexError(idx)
+        return UINT32.unpack_from(self._buf, self._offset + idx * UINT32.size)[0]
+
+
+class _KeyTable(object):
+    """a read only sequence of keys decoded from record indexes, it can be bisected"""
+
+    def __init__(self, indexes, key):
+        self._indexes = indexes
+        self._key = key
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, idx):
+        return self._key(self._indexes[idx])
+
+
+class CompiledInventory(object):
+    """A memory mapped inventory file, records are decoded on demand."""
+
+    def __init__(self, path):
+        with open(path, "rb") as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self._count,
+            self._signature,
+            self._strings_offset,
+            _,
+            self._records_offset,
+            self._ids_offset,
+            self._ids_size,
+            id_sorted_offset,
+            name_sorted_offset,
+        ) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise InventoryException("{} is not a valid inventory".format(path))
+        self._id_sorted = _Uint32Table(self._mmap, id_sorted_offset, self._count - 1)
+        self._name_sorted = _Uint32Table(
+            self._mmap, name_sorted_offset, self._count - 1
+        )
+        self._sorted_ids = _KeyTable(self._id_sorted, self.node_id)
+        self._sorted_names = _KeyTable(self._name_sorted, self.name)
+
+    def __len__(self):
+        return self._count
+
+    def signature(self):
+        """:returns: tree_signature of the root path when it was compiled"""
+        return self._signature
+
+    def record(self, idx):
+        return RECORD.unpack_from(self._mmap, self._records_offset + idx * RECORD.size)
+
+    def _string(self, offset, length):
+        offset += self._strings_offset
+        return self._mmap[offset : offset + length]
+
+    def parent(self, idx):
+        return self.record(idx)[0]
+
+    def subtree_end(self, idx):
+        return self.record(idx)[1]
+
+    def node_id(self, idx):
+        if idx == 0:
+            return None
+        record = self.record(idx)
+        offset = self._ids_offset + record[2]
+        return str(self._mmap[offset : offset + record[3]], "utf8")
+
+    def name(self, idx):
+        if idx == 0:
+            return None
+        record = self.record(idx)
+        return str(self._string(record[4], record[5]), "utf8")
+
+    def file_name(self, idx):
+        record = self.record(idx)
+        return str(self._string(record[6], record[7]), "utf8")
+
+    def config_data(self, idx):
+        """:returns: the pickled config, configs can be compared without loading them"""
+        record = self.record(idx)
+        return self._string(record[8], record[9])
+
+    def config(self, idx):
+        data = self.config_data(idx)
+        if len(data) == 0:
+            return None
+        return pickle.loads(data)
+
+    def is_dir(self, idx):
+        return self.record(idx)[10] & FLAG_DIR != 0
+
+    def find(self, node_id):
+        """:returns: record index of an id, or None"""
+        pos = bisect.bisect_left(self._sorted_ids, node_id)
+        if pos < len(self._sorted_ids) and self._sorted_ids[pos] == node_id:
+            return self._id_sorted[pos]
+        return None
+
+    def find_by_name(self, name):
+        """:returns: record indexes of a name"""
+        begin = bisect.bisect_left(self._sorted_names, name)
+        end = bisect.bisect_right(self._sorted_names, name, begin)
+        return [self._name_sorted[pos] for pos in range(begin, end)]
+
+    def ids(self):
+        return [self._sorted_ids[pos] for pos in range(len(self._sorted_ids))]
+
+    def ids_with_prefix(self, prefix):
+        begin = bisect.bisect_left(self._sorted_ids, prefix)
+        end = bisect.bisect_left(
+            self._sorted_ids, prefix[:-1] + chr(ord(prefix[-1]) + 1), begin
+        )
+        return [self._sorted_ids[pos] for pos in range(begin, end)]
+
+    def ids_containing(self, text):
+        """
+        Find ids containing the text by searching the blob of ids in the
+        mapping, only matched ids are decoded.
+
+        :returns: matched ids in order
+
+        """
+        results = []
+        needle = text.encode("utf8")
+        if b"\n" in needle:
+            return results
+        begin = self._ids_offset
+        end = begin + self._ids_size
+        found = self._mmap.find(needle, begin, end)
+        while found != -1:
+            id_begin = self._mmap.rfind(b"\n", begin, found) + 1
+            if id_begin == 0:
+                id_begin = begin
+            id_end = self._mmap.find(b"\n", found, end)
+            results.append(str(self._mmap[id_begin:id_end], "utf8"))
+            # continue from the next id
+            found = self._mmap.find(needle, id_end + 1, end)
+        return results
+
+
+class CompiledLoginInfoManager(LoginInfoManager):
+    """
+    A login info manager backed by a compiled inventory file. Nodes are
+    decoded on first access, so start-up doesn't depend on the number of
+    nodes. The children of a decoded node only contain decoded nodes, use
+    records of the inventory to enumerate a subtree.
+
+    The inventory shows login info as it was when it was compiled. It is
+    compiled again by reload, e.g. by the reload command or the file
+    watcher, by `slm --compile-inventory`, and on start-up if it is missing
+    or invalid. Changes made while slm is not running are not seen until
+    then, unless check is enabled, which compares a signature of all files
+    on start-up at the cost of stating every file.
+    """
+
+    def __init__(self, root_path, inventory_path, snapshot_path=None, check=False):
+        """
+        :root_path: root path of login info
+        :inventory_path: path of the compiled inventory file
+        :snapshot_path: path of the snapshot file, used when compiling again
+        :check: compile again on start-up if any file is changed since last compiling
+        """
+        # nodes are not walked or loaded by LoginInfoManager, only its fields are used
+        self._init_state(root_path, self.LAZY_LOADING)
+        self._inventory_path = inventory_path
+        self._snapshot_path = snapshot_path
+        # the inventory file is compiled by prepare_reload but not mapped yet
+        self._prepared = False
+        try:
+            self._open()
+        except (OSError, ValueError, struct.error, InventoryException) as e:
+            logger.warning("open %s failed, compile it again: %s", inventory_path, e)
+        else:
+            if not check or self._inventory.signature() == tree_signature(root_path):
+                return
+            logger.warning("login info is changed, compile %s again", inventory_path)
+        self.compile(root_path, inventory_path, snapshot_path)
+        self._open()
+
+    @classmethod
+    def compile(cls, root_path, inventory_path, snapshot_path=None):
+        """compile login info under root path into an inventory file"""
+        # taken before loading, so changes made meanwhile are found next time
+        signature = tree_signature(root_path)
+        login_info_manager = LoginInfoManager(
+            root_path, snapshot_path, LoginInfoManager.LAZY_LOADING
+        )
+        compile_inventory(login_info_manager, inventory_path, signature)
+        # configs parsed by compiling are saved for next time, all of them
+        # are loaded, so entries of removed files can be pruned
+        login_info_manager.save_snapshot(prune=True)
+
+    def _open(self):
+        self._inventory = CompiledInventory(self._inventory_path)
+        self._nodes = {}
+        self._batch_nodes_cache = {}
+        self._login_chains = {}
+
+    def _materialize(self, idx):
+        node = self._nodes.get(idx)
+        if node is not None:
+            return node
+        inventory = self._inventory
+        if idx == 0:
+            node = LoginInfoNode(inventory.file_name(0), is_dir=True)
+        else:
+            parent = self._materialize(inventory.parent(idx))
+            file_name = inventory.file_name(idx)
+            node = LoginInfoNode(file_name, file_name, parent, inventory.is_dir(idx))
+        # bind to the current inventory, it stays valid after reload
+        node.set_config_loader(lambda path: inventory.config(idx))
+        self._nodes[idx] = node
+        return node
+
+    def root_node(self):
+        return self._materialize(0)
+
+    def node_config(self, node):
+        idx = self._inventory.find(node.id()) if node.id() is not None else 0
+        return None if idx is None else self._inventory.config(idx)
+
+    def prepare_reload(self):
+        """compile the inventory again, reload maps the new file"""
+        self.compile(self._root_path, self._inventory_path, self._snapshot_path)
+        self._prepared = True
+
+    def reload(self):
+        """compile the inventory again unless it is prepared, and map the new file"""
+        begin = time.monotonic()
+        old_inventory = self._inventory
+        if self._prepared:
+            self._prepared = False
+        else:
+            self.compile(self._root_path, self._inventory_path, self._snapshot_path)
+        self._open()
+        old_ids = set(old_inventory.ids())
+        new_ids = set(self._inventory.ids())
+        result = ReloadResult()
+        result.added = sorted(new_ids - old_ids)
+        result.removed = sorted(old_ids - new_ids)
+        for node_id in sorted(old_ids & new_ids):
+            if old_inventory.config_data(old_inventory.find(node_id)) != (
+                self._inventory.config_data(self._inventory.find(node_id))
+            ):
+                result.modified.append(node_id)
+        result.elapsed = time.monotonic() - begin
+        return result
+
+    def save_snapshot(self, prune=None):
+        pass
+
+    def login_chain_errors(self):
+        # nodes are decoded on demand, broken chains are reported on login
+        return []
+
+    def _node_ids(self):
+        return self._inventory.ids()
+
+    def search_nodes(self, text, only_id=True, limit=None):
+        """
+        The same as LoginInfoManager.search_nodes, but ids are searched in
+        the mapped inventory instead of an index, which would decode all ids.
+        """
+        if text == "":
+            return []
+        ids = TrigramIndex.top(self._inventory.ids_containing(text), text, limit)
+        if only_id:
+            return ids
+        return [(id, self.node(id)) for id in ids]
+
+    def node(self, id):
+        idx = self._inventory.find(id)
+        if idx is None:
+            return None
+        return self._materialize(idx)
+
+    def nodes_by_name(self, name):
+        indexes = self._inventory.find_by_name(name)
+        if len(indexes) == 0:
+            return None
+        return [self._materialize(idx) for idx in indexes]
+
+    def _ids_with_prefix(self, prefix):
+        return self._inventory.ids_with_prefix(prefix)
+
+    def list_nodes(self, parent_id, only_id=True):
+        if parent_id == "":
+            return []
+        ids = self._inventory.ids_with_prefix(parent_id)
+        if only_id:
+            return ids
+        return [(id, self.node(id)) for id in ids]
+
+    def batch_nodes(self, parent_node):
+        parent_id = parent_node.id()
+        nodes = self._batch_nodes_cache.get(parent_id)
+        if nodes is not None:
+            return nodes
+        inventory = self._inventory
+        parent_idx = inventory.find(parent_id)
+        nodes = []
+        for idx in range(parent_idx + 1, inventory.subtree_end(parent_idx)):
+            if inventory.is_dir(idx):
+                continue
+            node = self._materialize(idx)
+            if not node.login_info().no_batch():
+                nodes.append(node)
+        nodes.sort(key=lambda node: node.id())
+        self._batch_nodes_cache[parent_id] = nodes
+        return nodes
+
+    def print_nodes(self):
+        for name in sorted(
+            {self._inventory.name(idx) for idx in range(1, len(self._inventory))}
+        ):
+            self._print_nodes(name, self.nodes_by_name(name))
+
+    def tree(self, root_id=""):
+        inventory = self._inventory
+        if root_id == "":
+            root_idx = 0
+        else:
+            root_idx = inventory.find(root_id)
+            if root_idx is None:
+                return None
+        from treelib import Tree
+
+        tree = Tree()
+        if root_idx == 0:
+            tree.create_node("root", "")
+        else:
+            tree.create_node(self._tag(self._materialize(root_idx)), root_id)
+        ids = {root_idx: root_id}
+        for idx in range(root_idx + 1, inventory.subtree_end(root_idx)):
+            node_id = inventory.node_id(idx)
+            tag = inventory.name(idx)
+            if not inventory.is_dir(idx):
+                tag = "{} -- {}".format(tag, node_id)
+            tree.create_node(tag, node_id, parent=ids[inventory.parent(idx)])
+            ids[idx] = node_id
+        return tree
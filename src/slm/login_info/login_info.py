@@ -1,18 +1,31 @@
 import json
 import os
 import readline
+import sys
 import yaml
 
 from functools import wraps
 
+# libyaml is much faster than the pure python loader if it is available
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 def heritable(enabled=True):
+    """
+    Make a property inherit from the parent if it's not set. Resolved values
+    are memoized in `_resolved` of login info until it is invalidated.
+    """
+
     def inner(func):
         @wraps(func)
         def from_parent(this, is_raw=False):
-            value = func(this)
             if not enabled:
-                return value
+                return func(this)
+            key = (func.__name__, is_raw)
+            resolved = this._resolved
+            if key in resolved:
+                return resolved[key]
+            value = func(this)
             if (
                 (value is None or value == Property.NONE_PROPERTY)
                 and hasattr(this, "parent")
@@ -22,7 +35,8 @@ def heritable(enabled=True):
                 if parent is not None:
                     value = getattr(parent, func.__name__)(is_raw=is_raw)
             if isinstance(value, Property) and not is_raw:
-                return value.val()
+                value = value.val()
+            resolved[key] = value
             return value
 
         return from_parent
@@ -30,25 +44,88 @@ def heritable(enabled=True):
     return inner
 
 
+def load_config(path):
+    """load a login info config file
+
+    :path: path of the config file
+    :returns: config dict, or None if the file doesn't exist
+
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as fin:
+        config = yaml.load(fin, Loader=SafeLoader)
+        if config is None:
+            config = {}
+        return config
+
+
+def load_configs(paths, workers):
+    """load config files in a process pool
+
+    :paths: paths of config files
+    :workers: number of processes
+    :returns: a list of configs in the same order of paths
+
+    """
+    if workers <= 1 or len(paths) <= 1:
+        return [load_config(path) for path in paths]
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunksize = max(1, len(paths) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(load_config, paths, chunksize=chunksize))
+
+
+def _intern(value):
+    """intern a string which is likely repeated in many config files"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
 class LoginInfoNode(object):
     NODE_CONF = ".base.yaml"
 
-    def __init__(self, path, name=None, parent=None):
-        """ """
-        self._path = path
-        self._name = name
+    __slots__ = (
+        "_file_name",
+        "_name",
+        "_id",
+        "_is_dir",
+        "_parent",
+        "_children",
+        "_login_info",
+        "_config_loader",
+        "_path",
+    )
+
+    def __init__(self, path, name=None, parent=None, is_dir=None):
+        """
+        :path: path of the file or directory, only the root node keeps the full path
+        :name: file name
+        :parent: parent node
+        :is_dir: whether path is a directory, it will be checked if it is None
+        """
+        self._file_name = path if parent is None else _intern(name)
+        self._name = self._file_name if parent is not None else name
+        self._is_dir = os.path.isdir(path) if is_dir is None else is_dir
         if parent is None or parent.id() is None:
             self._id = name
         else:
             self._id = ".".join((parent.id(), name))
         if self._name is not None:
             if self._name.endswith(".yaml"):
-                self._name = self._name[:-5]
+                self._name = _intern(self._name[:-5])
             elif self._name.endswith(".yml"):
-                self._name = self._name[:-4]
+                self._name = _intern(self._name[:-4])
         self._parent = parent
-        self._children = []
+        # most nodes are leaves, don't allocate a list for them
+        self._children = None
         self._login_info = None
+        # login info will be loaded on first access if a config loader is set
+        self._config_loader = None if parent is None else parent._config_loader
+        # path of a directory node, cached on first use so a leaf costs one join
+        self._path = None
 
         if parent is not None:
             parent._add_child(self)
@@ -57,46 +134,121 @@ class LoginInfoNode(object):
         """add a child node to this node
         :child: child node to be added
         """
+        if self._children is None:
+            self._children = []
         self._children.append(child)
 
+    def _remove_child(self, child):
+        """remove a child node from this node
+        :child: child node to be removed
+        """
+        self._children.remove(child)
+
+    def detach(self):
+        """detach this node from its parent"""
+        if self._parent is not None:
+            self._parent._remove_child(self)
+
     def __repr__(self):
         return self._id
 
     def has_child(self):
-        return len(self._children) > 0
+        return self._children is not None and len(self._children) > 0
 
     def children(self):
+        if self._children is None:
+            return []
         return self._children
 
     def id(self):
         return self._id
 
+    def is_dir(self):
+        return self._is_dir
+
     def login_info(self):
+        if self._login_info is None and self._config_loader is not None:
+            self.init_login_info(self._config_loader)
         return self._login_info
 
+    def is_login_info_loaded(self):
+        return self._login_info is not None
+
+    def set_config_loader(self, config_loader):
+        """
+        Set a config loader to load login info lazily, it is inherited by
+        nodes created after it.
+
+        :config_loader: function to load config from a path
+        """
+        self._config_loader = config_loader
+
     def name(self):
         return self._name
 
+    def file_name(self):
+        return self._file_name
+
     def parent(self):
         return self._parent
 
     def path(self):
-        return self._path
-
-    def init_login_info(self):
-        """ """
+        if self._parent is None:
+            return self._file_name
+        if self._path is not None:
+            return self._path
+        path = os.path.join(self._parent.path(), self._file_name)
+        if self._is_dir:
+            self._path = path
+        return path
+
+    def config_path(self):
+        """path of the config file of this node"""
+        if self._is_dir:
+            return os.path.join(self.path(), self.NODE_CONF)
+        return self.path()
+
+    def init_login_info(self, config_loader=load_config):
+        """
+        :config_loader: function to load config from a path
+        """
         if self._login_info is not None:
             return
 
-        path = self._path
-        if os.path.isdir(path):
-            path = os.path.join(path, self.NODE_CONF)
-        self._login_info = LoginInfo(self, path)
+        self._login_info = LoginInfo(self, self.config_path(), config_loader)
+
+    def reload_login_info(self, config_loader=load_config):
+        """
+        Reload login info in place, so login info of children still refer to it.
+
+        :config_loader: function to load config from a path
+        """
+        if self._login_info is None:
+            self.init_login_info(config_loader)
+            return
+
+        self._login_info.reload(self, self.config_path(), config_loader)
+        self._invalidate_descendants()
+
+    def _invalidate_descendants(self):
+        """descendants may inherit from this node, drop their resolved values"""
+        for child in self.children():
+            if child._login_info is not None:
+                child._login_info.invalidate()
+            child._invalidate_descendants()
 
 
 class Property(object):
     NONE_PROPERTY = None
 
+    __slots__ = (
+        "_name",
+        "_prompt_msg",
+        "_values",
+        "_default_index",
+        "_config_values",
+    )
+
     def __init__(self, name, prompt_msg=None):
         self._name = name
         self._prompt_msg = prompt_msg
@@ -215,13 +367,36 @@ Property.NONE_PROPERTY = Property(None)
 
 
 class LoginInfo(object):
-    def __init__(self, login_info_node, path):
+    __slots__ = (
+        "_resolved",
+        "_parent_login_info",
+        "_host",
+        "_next_login_format",
+        "_port",
+        "_credential",
+        "_previous_login",
+        "_after_hooks",
+        "_no_batch",
+        "_password_prompt",
+        "_shell_prompt",
+        "_mfa_prompt",
+        "_otp_prompt",
+        "_auto_exit_enabled",
+        "_login_timeout",
+        "_split_direction",
+    )
+
+    def __init__(self, login_info_node, path, config_loader=load_config):
         self._parent_login_info = (
             login_info_node.parent().login_info()
             if login_info_node.parent() is not None
             else None
         )
+        self.reload(login_info_node, path, config_loader)
 
+    def reload(self, login_info_node, path, config_loader=load_config):
+        """reset all fields and load them from path"""
+        self._resolved = {}
         self._host = login_info_node.name()
 
         # format: 'ssh -p{port} {user}@{host}'.format(port=22, user='viewlog', host='127.0.0.1')
@@ -236,34 +411,36 @@ class LoginInfo(object):
         # shell prompt: ]$
         self._shell_prompt = None
         self._mfa_prompt = None
+        self._otp_prompt = None
         self._auto_exit_enabled = None
         self._login_timeout = Property.NONE_PROPERTY
         self._split_direction = Property.NONE_PROPERTY
-        self._load(path)
+        self._load(path, config_loader)
 
-        if os.path.isdir(login_info_node.path()):
+        if login_info_node.is_dir():
             self._host = None
 
-    def _load(self, path):
-        if not os.path.exists(path):
+    def _load(self, path, config_loader):
+        config = config_loader(path)
+        if config is None:
             return
-        with open(path, "r") as fin:
-            config = yaml.safe_load(fin)
-            if config is None:
-                config = {}
-            host = config.get("HOST")
-            if host is not None:
-                self._host = host
-            self._port = config.get("PORT")
-            self._after_hooks = Property("AFTER_HOOKS").load(config)
-            self._credential = Property("CREDENTIAL").load(config)
-            self._next_login_format = config.get("NEXT_LOGIN_FORMAT")
-            self._password_prompt = config.get("PASSWORD_PROMPT")
-            self._shell_prompt = config.get("SHELL_PROMPT")
-            self._otp_prompt = config.get("OTP_PROMPT")
-            self._previous_login = config.get("PREVIOUS_LOGIN")
-            self._auto_exit_enabled = config.get("AUTO_EXIT_ENABLED")
-            self._no_batch = config.get("NO_BATCH")
+        host = config.get("HOST")
+        if host is not None:
+            self._host = host
+        self._port = config.get("PORT")
+        self._after_hooks = Property("AFTER_HOOKS").load(config)
+        self._credential = Property("CREDENTIAL").load(config)
+        self._next_login_format = _intern(config.get("NEXT_LOGIN_FORMAT"))
+        self._password_prompt = _intern(config.get("PASSWORD_PROMPT"))
+        self._shell_prompt = _intern(config.get("SHELL_PROMPT"))
+        self._otp_prompt = _intern(config.get("OTP_PROMPT"))
+        self._previous_login = _intern(config.get("PREVIOUS_LOGIN"))
+        self._auto_exit_enabled = config.get("AUTO_EXIT_ENABLED")
+        self._no_batch = config.get("NO_BATCH")
+
+    def invalidate(self):
+        """drop resolved values, they will be resolved again on next access"""
+        self._resolved = {}
 
     @heritable()
     def after_hooks(self):
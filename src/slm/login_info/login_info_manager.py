@@ -1,141 +1,502 @@
+import bisect
 import os
+import time
 
-from treelib import Tree
+from .login_info import LoginInfoNode, load_config, load_configs
+from .search_index import TrigramIndex
+from .snapshot import Snapshot
 
-from .login_info import LoginInfoNode
+
+class LoginChainError(Exception):
+    pass
+
+
+class ReloadResult(object):
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.modified = []
+        # errors of login chains found after reloading
+        self.errors = []
+        self.elapsed = 0
+
+    def has_change(self):
+        return len(self.added) > 0 or len(self.removed) > 0 or len(self.modified) > 0
+
+    def __repr__(self):
+        return "{} added, {} removed, {} modified in {:.3f}s".format(
+            len(self.added), len(self.removed), len(self.modified), self.elapsed
+        )
 
 
 class LoginInfoManager(object):
-    def __init__(self, root_path):
+    EAGER_LOADING = "eager"
+    LAZY_LOADING = "lazy"
+    # don't start a process pool for a few files
+    PARALLEL_LOADING_THRESHOLD = 256
+
+    def __init__(self, root_path, snapshot_path=None, loading=EAGER_LOADING, workers=1):
         """
         :root_path: root path of login info
+        :snapshot_path: path of the snapshot file, no snapshot will be used if it is None
+        :loading: eager or lazy, login info will be loaded on first access in lazy mode
+        :workers: number of processes to parse config files in eager mode, 0 means number of cpus
+        """
+        if workers == 0:
+            workers = os.cpu_count() or 1
+        self._init_state(root_path, loading, workers)
+        if snapshot_path is not None:
+            self._snapshot = Snapshot(snapshot_path, self._root_path)
+            self._snapshot.load()
+        self._walk_through()
+        if not self._lazy and not self._init_on_walk:
+            self._init_login_info_in_parallel(workers)
+        self.save_snapshot()
+
+        self._login_info_nodes_ids = sorted(self._login_info_nodes_id_cache.keys())
+        self._search_index = TrigramIndex(self._login_info_nodes_ids)
+        # broken login chains are reported on loading, except in lazy mode
+        self._login_chain_errors = [] if self._lazy else self.check_login_chains()
+
+    def _init_state(self, root_path, loading, workers=1):
+        """
+        Initialize all fields before anything is loaded, subclasses which
+        don't walk the root path call it instead of __init__.
         """
         self._login_info_nodes_cache = {}
         self._login_info_nodes_id_cache = {}
+        # signatures of loaded config files: path -> (mtime, size)
+        self._config_stats = {}
         self._root_path = root_path
         self._login_info_root_node = LoginInfoNode(self._root_path)
-        self._login_info_node_tree = Tree()
-        self._walk_through()
+        self._lazy = loading == self.LAZY_LOADING
+        if self._lazy:
+            self._login_info_root_node.set_config_loader(self._load_config)
+        # login info is loaded after walking if config files are parsed in parallel
+        self._init_on_walk = not self._lazy and workers <= 1
+        self._preloaded_configs = {}
+        self._snapshot = None
+        self._login_info_nodes_ids = []
+        self._search_index = TrigramIndex()
+        # node id -> descendant nodes which can be logged in by batch
+        self._batch_nodes_cache = {}
+        # node id -> a tuple of nodes to login one by one, or a LoginChainError
+        self._login_chains = {}
+        self._login_chain_errors = []
 
-        self._login_info_nodes_ids = sorted(self._login_info_nodes_id_cache.keys())
+    def _stat_config(self, path):
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def _load_config(self, path):
+        """load config of a path and remember its signature"""
+        stat = self._stat_config(path)
+        if stat is None:
+            self._config_stats[path] = None
+            return None
+        self._config_stats[path] = (stat.st_mtime_ns, stat.st_size)
+        if self._snapshot is not None:
+            return self._snapshot.config(path, stat, self._parse_config)
+        return self._parse_config(path)
+
+    def _parse_config(self, path):
+        if path in self._preloaded_configs:
+            return self._preloaded_configs.pop(path)
+        return load_config(path)
+
+    def _init_login_info_in_parallel(self, workers):
+        """parse config files in a process pool, then load login info of all nodes"""
+        # nodes are cached in pre-order, so a parent comes before its children
+        nodes = [self._login_info_root_node]
+        nodes.extend(self._login_info_nodes_id_cache.values())
+        paths = []
+        for node in nodes:
+            path = node.config_path()
+            if self._snapshot is not None:
+                stat = self._stat_config(path)
+                if stat is None or self._snapshot.is_fresh(path, stat):
+                    continue
+            paths.append(path)
+        if len(paths) < self.PARALLEL_LOADING_THRESHOLD:
+            workers = 1
+        self._preloaded_configs = dict(zip(paths, load_configs(paths, workers)))
+        for node in nodes:
+            node.init_login_info(self._load_config)
+        self._preloaded_configs = {}
+
+    def _is_config_changed(self, path):
+        stat = self._stat_config(path)
+        signature = None if stat is None else (stat.st_mtime_ns, stat.st_size)
+        return self._config_stats.get(path) != signature
 
     def _walk_through(self, path=None, parent_node=None):
         """walk through the root path and find all login info"""
         if path is None:
             path = self._root_path
             parent_node = self._login_info_root_node
-            self._login_info_node_tree.create_node("root", "")
-        if not os.path.isdir(path):
+        if not parent_node.is_dir():
             return None
 
-        parent_node.init_login_info()
-        if parent_node.parent() is not None:
-            if parent_node.parent().parent() is None:
-                self._login_info_node_tree.create_node(
-                    parent_node.name(), parent_node.id(), parent=""
-                )
-            else:
-                self._login_info_node_tree.create_node(
-                    parent_node.name(),
-                    parent_node.id(),
-                    parent=parent_node.parent().id(),
-                )
+        if self._init_on_walk:
+            parent_node.init_login_info(self._load_config)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                self._add_node(parent_node, entry.name, entry.is_dir())
 
-        for f in os.listdir(path):
-            if f.startswith("."):
-                continue
-            sub_path = os.path.join(path, f)
-            sub_node = LoginInfoNode(sub_path, f, parent_node)
-            if os.path.isdir(sub_path):
-                self._walk_through(sub_path, sub_node)
-            else:
-                sub_node.init_login_info()
-                name = sub_node.name()
-                if sub_node.login_info().host() is not None:
-                    name = "{} -- {}".format(name, sub_node.id())
-                if parent_node.parent() is None:
-                    self._login_info_node_tree.create_node(
-                        name, sub_node.id(), parent=""
-                    )
-                else:
-                    self._login_info_node_tree.create_node(
-                        name, sub_node.id(), parent=sub_node.parent().id()
-                    )
-
-            nodes = self._login_info_nodes_cache.get(sub_node.name())
-            if nodes is None:
-                nodes = []
-                self._login_info_nodes_cache[sub_node.name()] = nodes
-            nodes.append(sub_node)
-            self._login_info_nodes_id_cache[sub_node.id()] = sub_node
-
-    def search_nodes(self, text, only_id=True):
-        results = []
+    def _add_node(self, parent_node, f, is_dir):
+        """create a node for a file or directory in the directory of parent node"""
+        sub_path = os.path.join(parent_node.path(), f)
+        sub_node = LoginInfoNode(sub_path, f, parent_node, is_dir)
+        if self._init_on_walk:
+            sub_node.init_login_info(self._load_config)
+
+        # nodes are cached by id in pre-order, a parent comes before its children
+        self._login_info_nodes_id_cache[sub_node.id()] = sub_node
+        if sub_node.is_dir():
+            self._walk_through(sub_path, sub_node)
+        # a directory is cached by name after its descendants, nodes_by_name
+        # returns nodes of the same name in post-order, PREVIOUS_LOGIN takes the first
+        nodes = self._login_info_nodes_cache.get(sub_node.name())
+        if nodes is None:
+            nodes = []
+            self._login_info_nodes_cache[sub_node.name()] = nodes
+        nodes.append(sub_node)
+        return sub_node
+
+    def _remove_node(self, node, result):
+        """remove a node and all its descendants"""
+        for child in list(node.children()):
+            self._remove_node(child, result)
+        node.detach()
+        nodes = self._login_info_nodes_cache.get(node.name())
+        if nodes is not None:
+            nodes.remove(node)
+            if len(nodes) == 0:
+                del self._login_info_nodes_cache[node.name()]
+        del self._login_info_nodes_id_cache[node.id()]
+        config_path = node.config_path()
+        self._config_stats.pop(config_path, None)
+        if self._snapshot is not None:
+            self._snapshot.discard(config_path)
+        result.removed.append(node.id())
+
+    def _collect_ids(self, node, ids):
+        ids.append(node.id())
+        for child in node.children():
+            self._collect_ids(child, ids)
+
+    def _reload_dir(self, dir_node, result):
+        """diff a directory against its loaded children and patch the changes"""
+        # login info which is not loaded yet will be loaded on first access
+        if dir_node.is_login_info_loaded() and self._is_config_changed(
+            dir_node.config_path()
+        ):
+            dir_node.reload_login_info(self._load_config)
+            result.modified.append("" if dir_node.id() is None else dir_node.id())
+
+        children = {}
+        for child in dir_node.children():
+            children[child.file_name()] = child
+        with os.scandir(dir_node.path()) as entries:
+            entries = [entry for entry in entries if not entry.name.startswith(".")]
+        for entry in entries:
+            child = children.pop(entry.name, None)
+            if child is not None and entry.is_dir() != child.is_dir():
+                self._remove_node(child, result)
+                child = None
+            if child is None:
+                child = self._add_node(dir_node, entry.name, entry.is_dir())
+                self._collect_ids(child, result.added)
+            elif child.is_dir():
+                self._reload_dir(child, result)
+            elif child.is_login_info_loaded() and self._is_config_changed(
+                child.config_path()
+            ):
+                child.reload_login_info(self._load_config)
+                result.modified.append(child.id())
+        for child in children.values():
+            self._remove_node(child, result)
+
+    def reload(self):
+        """
+        Reload login info which have been changed since last loading.
+
+        :returns: a ReloadResult
+
+        """
+        begin = time.monotonic()
+        result = ReloadResult()
+        self._reload_dir(self._login_info_root_node, result)
+        for id in result.removed:
+            idx = bisect.bisect_left(self._login_info_nodes_ids, id)
+            if (
+                idx < len(self._login_info_nodes_ids)
+                and self._login_info_nodes_ids[idx] == id
+            ):
+                del self._login_info_nodes_ids[idx]
+            self._search_index.remove(id)
+        for id in result.added:
+            bisect.insort(self._login_info_nodes_ids, id)
+            self._search_index.add(id)
+        if result.has_change():
+            self._batch_nodes_cache = {}
+            self._login_chains = {}
+        if not self._lazy:
+            self._login_chain_errors = self.check_login_chains()
+            result.errors = self._login_chain_errors
+        self.save_snapshot()
+        result.elapsed = time.monotonic() - begin
+        return result
+
+    def search_nodes(self, text, only_id=True, limit=None):
+        """
+        Search nodes whose id contains the text. Results are ranked by exact
+        segment, segment prefix and substring matches.
+
+        :limit: max number of results, None means all
+        """
         if text == "":
-            return results
-        for id in self._login_info_nodes_ids:
-            if text in id:
-                if only_id:
-                    results.append(id)
-                else:
-                    results.append((id, self._login_info_nodes_id_cache.get(id)))
-        return results
+            return []
+        ids = self._search_index.search(text, self._login_info_nodes_ids, limit)
+        if only_id:
+            return ids
+        return [(id, self.node(id)) for id in ids]
 
     def node(self, id):
         return self._login_info_nodes_id_cache.get(id)
 
+    def root_node(self):
+        return self._login_info_root_node
+
+    def node_config(self, node):
+        """:returns: parsed config of a node, or None if it has no config file"""
+        return self._load_config(node.config_path())
+
     def nodes_by_name(self, name):
         return self._login_info_nodes_cache.get(name)
 
+    def login_chain(self, node):
+        """
+        Resolve nodes to login one by one before logging in a node, following
+        PREVIOUS_LOGIN. Chains are cached until login info is reloaded. A
+        PREVIOUS_LOGIN which doesn't match any node ends the chain, so its
+        node is logged in directly, see previous_login_warning.
+
+        :node: target node
+        :returns: a tuple of nodes, from the first hop to the target node
+        :raises LoginChainError: if there is a cycle
+
+        """
+        chain = self._login_chains.get(node.id())
+        if chain is None:
+            chain = self._resolve_login_chain(node, [])
+        if isinstance(chain, LoginChainError):
+            raise chain
+        return chain
+
+    def _resolve_login_chain(self, node, visiting_ids):
+        id = node.id()
+        chain = self._login_chains.get(id)
+        if chain is not None:
+            return chain
+        if id in visiting_ids:
+            cycle = visiting_ids[visiting_ids.index(id) :] + [id]
+            # ids are collected from the target to the first hop
+            cycle.reverse()
+            return LoginChainError("cycle in login chain: " + " -> ".join(cycle))
+        previous_login = node.login_info().previous_login()
+        nodes = None
+        if previous_login is not None:
+            nodes = self.nodes_by_name(previous_login)
+        if nodes is None:
+            chain = (node,)
+        else:
+            # TODO prompt to let user select
+            visiting_ids.append(id)
+            chain = self._resolve_login_chain(nodes[0], visiting_ids)
+            visiting_ids.pop()
+            if not isinstance(chain, LoginChainError):
+                chain = chain + (node,)
+        self._login_chains[id] = chain
+        return chain
+
+    def previous_login_warning(self, node):
+        """
+        :node: the first hop of a login chain
+        :returns: a warning if PREVIOUS_LOGIN of the node doesn't match any node, or None
+        """
+        previous_login = node.login_info().previous_login()
+        if previous_login is None or self.nodes_by_name(previous_login) is not None:
+            return None
+        return (
+            "PREVIOUS_LOGIN {} of {} doesn't match any node, login it directly".format(
+                previous_login, node.id()
+            )
+        )
+
+    def login_chain_errors(self):
+        """:returns: error messages of broken login chains found on last loading"""
+        return self._login_chain_errors
+
+    def check_login_chains(self):
+        """
+        Resolve login chains of all nodes with host.
+
+        :returns: error messages of broken login chains, and warnings of
+            PREVIOUS_LOGIN which doesn't match any node
+
+        """
+        errors = []
+        for id in self._node_ids():
+            node = self.node(id)
+            if node.is_dir() or node.login_info().host() is None:
+                continue
+            try:
+                message = self.previous_login_warning(self.login_chain(node)[0])
+            except LoginChainError as e:
+                message = str(e)
+            # nodes sharing a broken chain share the same error
+            if message is not None and message not in errors:
+                errors.append(message)
+        return errors
+
+    def _node_ids(self):
+        """:returns: ids of all nodes in order"""
+        return self._login_info_nodes_ids
+
+    def prepare_reload(self):
+        """
+        Do the slow part of reload which doesn't change loaded login info,
+        so it can be done without holding the lock of the manager. reload
+        must be called after it. Nothing is done by default.
+        """
+        pass
+
+    def save_snapshot(self, prune=None):
+        """
+        Save parsed login info to the snapshot file if it is changed.
+
+        :prune: remove entries of files which are not loaded, default: True
+            unless in lazy mode, where some files may not be loaded yet
+        """
+        if self._snapshot is None:
+            return
+        self._snapshot.save(not self._lazy if prune is None else prune)
+
+    def _ids_with_prefix(self, prefix):
+        """ids starting with prefix, found by bisecting the sorted ids"""
+        ids = self._login_info_nodes_ids
+        begin = bisect.bisect_left(ids, prefix)
+        end = bisect.bisect_left(ids, prefix[:-1] + chr(ord(prefix[-1]) + 1), begin)
+        return ids[begin:end]
+
     def list_nodes(self, parent_id, only_id=True):
-        results = []
         if parent_id == "":
-            return results
-        for id in self._login_info_nodes_ids:
-            if id.startswith(parent_id):
-                if only_id:
-                    results.append(id)
-                else:
-                    results.append((id, self._login_info_nodes_id_cache.get(id)))
-        return results
+            return []
+        ids = self._ids_with_prefix(parent_id)
+        if only_id:
+            return ids
+        return [(id, self._login_info_nodes_id_cache.get(id)) for id in ids]
+
+    def batch_nodes(self, parent_node):
+        """
+        Find all descendant nodes of parent node which have host and are not
+        marked as NO_BATCH. Results are cached until something is reloaded.
+
+        :parent_node: parent node
+        :returns: a list of nodes ordered by id
+
+        """
+        parent_id = parent_node.id()
+        nodes = self._batch_nodes_cache.get(parent_id)
+        if nodes is not None:
+            return nodes
+        nodes = []
+        for id in self._ids_with_prefix(parent_id + "."):
+            node = self._login_info_nodes_id_cache[id]
+            # a file name can contain dots, make sure it is under parent node
+            ancestor = node.parent()
+            while ancestor is not None and ancestor is not parent_node:
+                ancestor = ancestor.parent()
+            if ancestor is None:
+                continue
+            if (
+                node.login_info().host() is not None
+                and not node.login_info().no_batch()
+            ):
+                nodes.append(node)
+        self._batch_nodes_cache[parent_id] = nodes
+        return nodes
 
     def print_nodes(self):
         for name, nodes in self._login_info_nodes_cache.items():
-            print(name + ":")
-            count = 0
-            for node in nodes:
-                print("\t{}:".format(count))
-                print("\t\t{}:[{}]".format("id", node.id()))
-                print("\t\t{}:[{}]".format("host", node.login_info().host()))
-                print("\t\t{}:[{}]".format("port", node.login_info().port()))
-                print(
-                    "\t\t{}:[{}]".format("credential", node.login_info().credential())
-                )
-                print(
-                    "\t\t{}:[{}]".format(
-                        "next_login_format", node.login_info().next_login_format()
-                    )
-                )
-                print(
-                    "\t\t{}:[{}]".format(
-                        "password_prompt", node.login_info().password_prompt()
-                    )
-                )
-                print(
-                    "\t\t{}:[{}]".format(
-                        "shell_prompt", node.login_info().shell_prompt()
-                    )
+            self._print_nodes(name, nodes)
+
+    def _print_nodes(self, name, nodes):
+        print(name + ":")
+        count = 0
+        for node in nodes:
+            print("\t{}:".format(count))
+            print("\t\t{}:[{}]".format("id", node.id()))
+            print("\t\t{}:[{}]".format("host", node.login_info().host()))
+            print("\t\t{}:[{}]".format("port", node.login_info().port()))
+            print("\t\t{}:[{}]".format("credential", node.login_info().credential()))
+            print(
+                "\t\t{}:[{}]".format(
+                    "next_login_format", node.login_info().next_login_format()
                 )
-                print(
-                    "\t\t{}:[{}]".format(
-                        "previous_login", node.login_info().previous_login()
-                    )
+            )
+            print(
+                "\t\t{}:[{}]".format(
+                    "password_prompt", node.login_info().password_prompt()
                 )
-                print(
-                    "\t\t{}:[{}]".format("after_hooks", node.login_info().after_hooks())
+            )
+            print(
+                "\t\t{}:[{}]".format("shell_prompt", node.login_info().shell_prompt())
+            )
+            print(
+                "\t\t{}:[{}]".format(
+                    "previous_login", node.login_info().previous_login()
                 )
-                count += 1
-            print("--------")
+            )
+            print("\t\t{}:[{}]".format("after_hooks", node.login_info().after_hooks()))
+            count += 1
+        print("--------")
+
+    def _tag(self, node):
+        # only a node of a file has host
+        if node.is_dir():
+            return node.name()
+        return "{} -- {}".format(node.name(), node.id())
+
+    def tree(self, root_id=""):
+        """
+        Build a tree of a node and its descendants for display, the whole
+        tree is built if root_id is empty.
+
+        :root_id: id of the root node of the tree
+        :returns: a treelib Tree, or None if the node doesn't exist
+
+        """
+        if root_id == "":
+            root_node = self._login_info_root_node
+        else:
+            root_node = self.node(root_id)
+            if root_node is None:
+                return None
+        from treelib import Tree
 
-    def tree(self):
-        return self._login_info_node_tree
+        tree = Tree()
+        tree.create_node("root" if root_id == "" else self._tag(root_node), root_id)
+        parents = [(root_node, root_id)]
+        while len(parents) > 0:
+            parent_node, parent_id = parents.pop()
+            for node in parent_node.children():
+                tree.create_node(self._tag(node), node.id(), parent=parent_id)
+                if node.has_child():
+                    parents.append((node, node.id()))
+        return tree
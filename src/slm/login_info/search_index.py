@@ -0,0 +1,138 @@
+import bisect
+from array import array
+
+
+class TrigramIndex(object):
+    """
+    An inverted index from trigrams to ids, so a substring search only needs
+    to check ids containing a trigram of the text. Ids are kept once in a
+    list, posting lists are sorted arrays of their handles.
+    """
+
+    N = 3
+    # scan all ids if candidates are more than this fraction of them
+    LINEAR_SCAN_RATIO = 0.25
+
+    def __init__(self, ids=()):
+        """
+        :ids: ids to be indexed
+        """
+        # handle -> id, None if it is removed
+        self._ids = []
+        self._handles = {}
+        self._postings = {}
+        for id in ids:
+            self.add(id)
+
+    def _grams(self, text):
+        return {text[i : i + self.N] for i in range(len(text) - self.N + 1)}
+
+    def add(self, id):
+        if id in self._handles:
+            return
+        # handles only grow, so appending keeps posting lists sorted
+        handle = len(self._ids)
+        self._ids.append(id)
+        self._handles[id] = handle
+        for gram in self._grams(id):
+            handles = self._postings.get(gram)
+            if handles is None:
+                handles = array("I")
+                self._postings[gram] = handles
+            handles.append(handle)
+
+    def remove(self, id):
+        handle = self._handles.pop(id, None)
+        if handle is None:
+            return
+        self._ids[handle] = None
+        for gram in self._grams(id):
+            handles = self._postings.get(gram)
+            if handles is None:
+                continue
+            pos = bisect.bisect_left(handles, handle)
+            if pos < len(handles) and handles[pos] == handle:
+                del handles[pos]
+            if len(handles) == 0:
+                del self._postings[gram]
+
+    def candidates(self, text):
+        """
+        Find ids which may contain the text, from the shortest posting list
+        of trigrams of the text.
+
+        :text: text to search
+        :returns: a list of ids, or None if the index doesn't narrow down ids
+            enough, because the text is too short or its trigrams are common
+
+        """
+        if len(text) < self.N:
+            return None
+        shortest = None
+        for gram in self._grams(text):
+            handles = self._postings.get(gram)
+            if handles is None:
+                return []
+            if shortest is None or len(handles) < len(shortest):
+                shortest = handles
+        if len(shortest) > len(self._handles) * self.LINEAR_SCAN_RATIO:
+            return None
+        return [self._ids[handle] for handle in shortest]
+
+    @classmethod
+    def top(cls, ids, text, limit=None):
+        """
+        Order matched ids by how they match the text: exact segment matches
+        first, then segment prefix matches, then other substring matches.
+        Ids are put into a bucket of their rank in one pass, so ids of the
+        same rank stay in order without sorting.
+
+        :ids: ids containing the text, in order
+        :text: text to search
+        :limit: max number of results, None means all
+        :returns: a list of ids
+
+        """
+        dot_text = "." + text
+        text_dot = text + "."
+        dot_text_dot = dot_text + "."
+        # a text ending with a dot is a segment prefix at the end of an id too
+        dot_stem = dot_text[:-1] if text.endswith(".") else None
+        exact_ids = []
+        prefix_ids = []
+        substring_ids = []
+        for id in ids:
+            if (
+                id.startswith(text)
+                or dot_text in id
+                or (dot_stem is not None and id.endswith(dot_stem))
+            ):
+                if (
+                    id == text
+                    or id.startswith(text_dot)
+                    or id.endswith(dot_text)
+                    or dot_text_dot in id
+                ):
+                    exact_ids.append(id)
+                else:
+                    prefix_ids.append(id)
+            else:
+                substring_ids.append(id)
+        results = exact_ids + prefix_ids + substring_ids
+        return results if limit is None else results[:limit]
+
+    def search(self, text, sorted_ids, limit=None):
+        """
+        Search ids containing the text.
+
+        :text: text to search
+        :sorted_ids: all ids in order, scanned if the index doesn't help
+        :limit: max number of results, None means all
+        :returns: matched ids ordered by rank and then id
+
+        """
+        candidates = self.candidates(text)
+        if candidates is None:
+            return self.top([id for id in sorted_ids if text in id], text, limit)
+        # candidates are in the order of handles, ids added later are at the end
+        return self.top(sorted(id for id in candidates if text in id), text, limit)
@@ -0,0 +1,159 @@
+import logging
+import os
+import pickle
+import tempfile
+from stat import S_IWGRP, S_IWOTH
+
+from .login_info import load_config
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot(object):
+    """
+    A compiled snapshot of all config files under the root path of login info.
+    An entry is keyed by the path relative to the root path, and holds the
+    mtime, the size and the parsed config of the file. A config file will be
+    parsed again only if its mtime or size changed.
+
+    The snapshot is pickled, loading it can run arbitrary code, so a file
+    which is not owned by the current user, or is writable by others, is
+    ignored and replaced.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, root_path):
+        """
+        :path: path of the snapshot file
+        :root_path: root path of login info
+        """
+        self._path = path
+        self._root_path = root_path
+        self._entries = {}
+        # keys looked up since loading, other entries are of removed files
+        self._used = set()
+        self._dirty = False
+
+    def load(self):
+        """load entries from the snapshot file, a broken or unsafe snapshot is ignored"""
+        if not os.path.exists(self._path):
+            self._dirty = True
+            return
+        try:
+            with open(self._path, "rb") as fin:
+                if not self._is_safe(os.fstat(fin.fileno())):
+                    logger.warning(
+                        "snapshot %s is not private to current user, ignore it",
+                        self._path,
+                    )
+                    self._dirty = True
+                    return
+                data = pickle.load(fin)
+            if (
+                data.get("version") != self.VERSION
+                or data.get("root_path") != self._root_path
+            ):
+                logger.info("snapshot %s is outdated, ignore it", self._path)
+                self._dirty = True
+                return
+            self._entries = data["entries"]
+        except Exception:
+            logger.warning("failed to load snapshot %s", self._path, exc_info=True)
+            self._entries = {}
+            self._dirty = True
+
+    def _is_safe(self, file_stat):
+        if hasattr(os, "getuid") and file_stat.st_uid != os.getuid():
+            return False
+        return file_stat.st_mode & (S_IWGRP | S_IWOTH) == 0
+
+    def is_fresh(self, path, stat):
+        """
+        :path: path of a config file
+        :stat: result of os.stat of the path
+        :returns: True if the file is unchanged since it was put in snapshot
+
+        """
+        key = self._key(path)
+        self._used.add(key)
+        entry = self._entries.get(key)
+        return (
+            entry is not None
+            and entry[0] == stat.st_mtime_ns
+            and entry[1] == stat.st_size
+        )
+
+    def config(self, path, stat, config_loader=load_config):
+        """
+        Load config of a path, parsed config in snapshot will be used if the
+        file is unchanged.
+
+        :path: path of a config file
+        :stat: result of os.stat of the path
+        :config_loader: function to parse the file if it is changed
+        :returns: config dict, or None if the file doesn't exist
+
+        """
+        key = self._key(path)
+        self._used.add(key)
+        if self.is_fresh(path, stat):
+            return self._entries[key][2]
+        config = config_loader(path)
+        if config is None:
+            return None
+        self._entries[key] = (stat.st_mtime_ns, stat.st_size, config)
+        self._dirty = True
+        return config
+
+    def discard(self, path):
+        """remove the entry of a removed config file"""
+        if self._entries.pop(self._key(path), None) is not None:
+            self._dirty = True
+
+    def _key(self, path):
+        prefix = self._root_path.rstrip(os.sep) + os.sep
+        if path.startswith(prefix):
+            return path[len(prefix) :]
+        return os.path.relpath(path, self._root_path)
+
+    def save(self, prune=False):
+        """
+        Write entries to the snapshot file atomically. Nothing will be written
+        if there is no change.
+
+        :prune: remove entries which are not looked up since loading, only if
+            all config files are looked up, e.g. after loading eagerly
+        """
+        if prune and len(self._entries) > 0:
+            unused = self._entries.keys() - self._used
+            for key in unused:
+                del self._entries[key]
+            if len(unused) > 0:
+                self._dirty = True
+        if not self._dirty:
+            return
+        dir_path = os.path.dirname(self._path)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=".{}.".format(os.path.basename(self._path)), dir=dir_path
+        )
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                pickle.dump(
+                    {
+                        "version": self.VERSION,
+                        "root_path": self._root_path,
+                        "entries": self._entries,
+                    },
+                    fout,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(tmp_path, self._path)
+        except Exception:
+            logger.warning("failed to save snapshot %s", self._path, exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._dirty = False
@@ -1,6 +1,7 @@
 import logging
 import os
 import sys
+import yaml
 
 from optparse import OptionParser, Option
 
@@ -16,6 +17,15 @@ option_parser.add_option(
         help="path of config file, default: ~/.slm.yaml",
     )
 )
+option_parser.add_option(
+    Option(
+        "--compile-inventory",
+        action="store_true",
+        dest="compile_inventory",
+        default=False,
+        help="compile login info into LOGIN_INFO_INVENTORY_PATH and exit",
+    )
+)
 logger = logging.getLogger(__name__)
 
 
@@ -27,7 +37,18 @@ def run():
     if not os.path.exists(config_path):
         print("config file '{}' doesn't exist".format(config_path), file=sys.stderr)
         sys.exit(1)
-    manager = Manager(config_path)
+    if options.compile_inventory:
+        with open(config_path, "r") as fin:
+            config = yaml.safe_load(fin) or {}
+        if config.get("LOGIN_INFO_INVENTORY_PATH") is None:
+            print(
+                "LOGIN_INFO_INVENTORY_PATH is not set in '{}'".format(config_path),
+                file=sys.stderr,
+            )
+            sys.exit(1)
+    manager = Manager(config_path, options.compile_inventory)
+    if options.compile_inventory:
+        return
     manager.run()
 
 
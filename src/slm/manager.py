@@ -1,48 +1,53 @@
 import cmd
+import contextlib
+import hashlib
 import logging
 import logging.config
 import os
 import readline
 import sys
+import threading
 import weakref
 import yaml
 
-from pynput.keyboard import Key, Controller
-
 from .setting import setting
+from .login_info.login_info import LoginInfoNode
+from .login_info.inventory import CompiledLoginInfoManager
 from .login_info.login_info_manager import LoginInfoManager
+from .util.file_watcher import FileWatcher
+from .util.secret_cache import SecretCache
 
 logger = logging.getLogger(__name__)
 
 COMPLETER_DELIMS = " \t\n"
 
 
-def extend_command(clazz, commandClass):
+def extend_command(clazz, name):
     def run(this, arg):
-        c = commandClass(this, this._manager, this._login_info_manager)
-        args = [] if arg is None else arg.split()
+        c = this.command(name)
+        args = c.split_args(arg)
         this.clear_completer_state()
         return c.run(args)
 
     def help(this):
-        c = commandClass(this, this._manager, this._login_info_manager)
+        c = this.command(name)
         this.clear_completer_state()
         return c.help()
 
     def complete(this, line_parser):
-        c = commandClass(this, this._manager, this._login_info_manager)
+        c = this.command(name)
         return c.complete(line_parser)
 
-    setattr(clazz, "do_" + commandClass.name(), run)
-    setattr(clazz, "help_" + commandClass.name(), help)
-    setattr(clazz, "complete_" + commandClass.name(), complete)
+    setattr(clazz, "do_" + name, run)
+    setattr(clazz, "help_" + name, help)
+    setattr(clazz, "complete_" + name, complete)
 
 
 def extend_commands(clazz):
     from . import command
 
-    for commandClass in command.__all__:
-        extend_command(clazz, commandClass)
+    for name in command.COMMANDS:
+        extend_command(clazz, name)
 
     return clazz
 
@@ -214,42 +219,96 @@ class ManagerShell(cmd.Cmd):
         self._login_info_manager = manager.login_info_manager()
         self.allow_cli_args = False
         self._completer_state = CompleterState(self)
-        self._keyboard = Controller()
+        # command name -> command instance, they are recreated after reload
+        self._commands = {}
+        self._plugin_commands_loaded = False
+        # pynput connects to the display server, create it on first use
+        self._keyboard = None
 
     #        readline.set_completion_display_matches_hook(
     #                create_completion_display_matches_func(self))
 
     def update(self):
         self._login_info_manager = self._manager.login_info_manager()
+        self._commands = {}
+
+    def command(self, name):
+        """
+        The command instance of this shell, it is created on first use.
+
+        :name: name of the command
+        :returns: a command instance
+
+        """
+        c = self._commands.get(name)
+        if c is None:
+            from . import command
+
+            c = command.load_command_class(name)(
+                self, self._manager, self._login_info_manager
+            )
+            self._commands[name] = c
+        return c
+
+    def _load_plugin_commands(self):
+        """add commands registered by entry points to this shell"""
+        if self._plugin_commands_loaded:
+            return
+        self._plugin_commands_loaded = True
+        from . import command
+
+        for name in command.plugin_commands():
+            extend_command(type(self), name)
+
+    def get_names(self):
+        self._load_plugin_commands()
+        return super().get_names()
+
+    def default(self, line):
+        cmd, _, _ = self.parseline(line)
+        if not self._plugin_commands_loaded and cmd is not None:
+            self._load_plugin_commands()
+            if hasattr(self, "do_" + cmd):
+                # the lock is held by onecmd already, don't hold it twice
+                return super().onecmd(line)
+        return super().default(line)
 
     def clear_completer_state(self):
         self._completer_state.clear()
 
-    def move_cursor_left(self, n):
+    def _press(self, key_name, n):
+        from pynput.keyboard import Key, Controller
+
+        if self._keyboard is None:
+            self._keyboard = Controller()
+        key = getattr(Key, key_name)
         while n > 0:
-            self._keyboard.press(Key.left)
-            self._keyboard.release(Key.left)
+            self._keyboard.press(key)
+            self._keyboard.release(key)
             n -= 1
 
+    def move_cursor_left(self, n):
+        self._press("left", n)
+
     def move_cursor_right(self, n):
-        while n > 0:
-            self._keyboard.press(Key.right)
-            self._keyboard.release(Key.right)
-            n -= 1
+        self._press("right", n)
 
     def tab(self, n):
-        while n > 0:
-            self._keyboard.press(Key.tab)
-            self._keyboard.release(Key.tab)
-            n -= 1
+        self._press("tab", n)
 
     def complete(self, text, state):
         try:
-            return self._completer_state.try_complete(state)
+            with self._manager.lock():
+                return self._completer_state.try_complete(state)
         except Exception:
             logger.exception("try_complete failed")
             return None
 
+    def onecmd(self, line):
+        # login info may be changed by the file watcher in background
+        with self._manager.lock():
+            return super().onecmd(line)
+
     def do_quit(self, arg):
         return True
 
@@ -269,17 +328,23 @@ class ManagerShell(cmd.Cmd):
             self._manager.close()
         if line != "":
             print()
+        # background jobs finished while running the command
+        for notification in self._manager.pop_job_notifications():
+            print(notification)
         return stop
 
 
 class Manager(object):
-    def __init__(self, config_path):
+    def __init__(self, config_path, compile_inventory=False):
         """
 
         :config_path: path of config file
+        :compile_inventory: compile login info into the inventory file before loading it
 
         """
         self._stopped = False
+        self._lock = threading.RLock()
+        self._file_watcher = None
         with open(config_path, "r") as fin:
             config = yaml.safe_load(fin)
             if config is not None:
@@ -288,7 +353,89 @@ class Manager(object):
         self._init_log()
         self._tmp_bin_path = os.path.expanduser(setting.TMP_BIN_PATH)
         self._login_info_root_path = os.path.expanduser(setting.LOGIN_INFO_ROOT_PATH)
-        self._login_info_manager = LoginInfoManager(self._login_info_root_path)
+        self._login_info_snapshot_path = self._get_login_info_snapshot_path()
+        self._login_info_inventory_path = None
+        if setting.LOGIN_INFO_INVENTORY_PATH is not None:
+            self._login_info_inventory_path = os.path.expanduser(
+                setting.LOGIN_INFO_INVENTORY_PATH
+            )
+        if compile_inventory:
+            self.compile_inventory()
+        self._login_info_manager = self._create_login_info_manager()
+        for error in self._login_info_manager.login_chain_errors():
+            print(error)
+        self._secret_cache = SecretCache(
+            setting.SECRETS_CACHE_TTL, setting.SECRETS_BATCH_HOOK
+        )
+        # background jobs of login, created on first use
+        self._job_manager = None
+        # time spent in phases of logging in, created on first use
+        self._login_stats = None
+        if setting.WATCH_LOGIN_INFO:
+            self._file_watcher = FileWatcher(
+                self._login_info_root_path,
+                self._on_login_info_changed,
+                mode=setting.WATCH_MODE,
+                poll_interval=setting.WATCH_POLL_INTERVAL,
+                name_filter=self._is_login_info_file_name,
+            )
+
+    def _create_login_info_manager(self):
+        if self._login_info_inventory_path is None:
+            return LoginInfoManager(
+                self._login_info_root_path,
+                self._login_info_snapshot_path,
+                setting.LOGIN_INFO_LOADING,
+                setting.LOGIN_INFO_LOADING_WORKERS,
+            )
+        if not os.path.exists(self._login_info_inventory_path):
+            self.compile_inventory()
+        return CompiledLoginInfoManager(
+            self._login_info_root_path,
+            self._login_info_inventory_path,
+            self._login_info_snapshot_path,
+            setting.LOGIN_INFO_INVENTORY_CHECK,
+        )
+
+    def compile_inventory(self):
+        """compile login info into the inventory file"""
+        if self._login_info_inventory_path is None:
+            raise Exception("LOGIN_INFO_INVENTORY_PATH is not set")
+        self._make_sure_directory_exists(self._login_info_inventory_path)
+        CompiledLoginInfoManager.compile(
+            self._login_info_root_path,
+            self._login_info_inventory_path,
+            self._login_info_snapshot_path,
+        )
+
+    def _is_login_info_file_name(self, name):
+        return not name.startswith(".") or name == LoginInfoNode.NODE_CONF
+
+    def _on_login_info_changed(self):
+        # the slow part is done without the lock, so the shell isn't blocked
+        self._login_info_manager.prepare_reload()
+        with self._lock:
+            result = self._login_info_manager.reload()
+        if result.has_change():
+            logger.info("login info is reloaded by file watcher: %s", result)
+        for error in result.errors:
+            logger.warning(error)
+
+    def _get_login_info_snapshot_path(self):
+        if not setting.LOGIN_INFO_SNAPSHOT_ENABLED:
+            return None
+        if setting.LOGIN_INFO_SNAPSHOT_PATH is not None:
+            snapshot_path = os.path.expanduser(setting.LOGIN_INFO_SNAPSHOT_PATH)
+            self._make_sure_directory_exists(snapshot_path)
+            return snapshot_path
+        # named by the root path, so snapshots of different roots are kept apart
+        root_path = os.path.abspath(self._login_info_root_path).rstrip(os.sep)
+        snapshot_path = os.path.join(
+            os.path.expanduser(setting.CACHE_PATH),
+            "{}.snapshot".format(hashlib.sha1(root_path.encode("utf8")).hexdigest()),
+        )
+        self._make_sure_directory_exists(snapshot_path, mode=0o700)
+        return snapshot_path
 
     def _init_log(self):
         log_file_path = os.path.expanduser(setting.LOG_FILE_PATH)
@@ -333,19 +480,82 @@ class Manager(object):
 
         logging.captureWarnings(True)
 
-    def _make_sure_directory_exists(self, path):
+    def _make_sure_directory_exists(self, path, mode=0o777):
         dir_path = os.path.dirname(path)
         if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
+            os.makedirs(dir_path, mode)
 
     def close(self):
+        if self._job_manager is not None:
+            self._job_manager.close()
+        if self._login_stats is not None:
+            self._login_stats.close()
+        if setting.SSH_CONTROL_MASTER:
+            from .util.ssh_control import stop_masters
+
+            stop_masters()
+        self._secret_cache.wipe()
         print("bye!")
 
     def login_info_manager(self):
         return self._login_info_manager
 
+    def secret_cache(self):
+        return self._secret_cache
+
+    def job_manager(self):
+        if self._job_manager is None:
+            from .util.job_manager import JobManager
+
+            self._job_manager = JobManager()
+        return self._job_manager
+
+    def login_stats(self):
+        if self._login_stats is None:
+            from .util.login_stats import LoginStats
+
+            self._login_stats = LoginStats(
+                setting.LOGIN_STATS_SIZE, setting.LOGIN_METRICS_PATH
+            )
+        return self._login_stats
+
+    def pop_job_notifications(self):
+        """:returns: lines about jobs finished since last call"""
+        if self._job_manager is None:
+            return []
+        return self._job_manager.pop_notifications()
+
+    def lock(self):
+        """lock to hold while reading or changing login info"""
+        return self._lock
+
+    @contextlib.contextmanager
+    def unlocked(self):
+        """
+        Release the lock held by the shell while running a command, so login
+        info can be reloaded while waiting for something slow, like running
+        a command on many nodes. Nothing read from login info before is
+        valid inside.
+        """
+        self._lock.release()
+        try:
+            yield
+        finally:
+            self._lock.acquire()
+
     def reload(self, shell):
-        self._login_info_manager = LoginInfoManager(self._login_info_root_path)
+        """reload changed login info and print a summary of changes"""
+        result = self._login_info_manager.reload()
+        for title, ids in (
+            ("added", result.added),
+            ("removed", result.removed),
+            ("modified", result.modified),
+        ):
+            for id in ids:
+                print("{}: {}".format(title, "<root>" if id == "" else id))
+        for error in result.errors:
+            print(error)
+        print("reload finished: {}".format(result))
         shell.update()
 
     def run(self):
@@ -354,6 +564,9 @@ class Manager(object):
         if os.path.exists(history_file_path):
             readline.read_history_file(history_file_path)
         shell = ManagerShell(self)
+        if self._file_watcher is not None:
+            self._file_watcher.start()
+            logger.info("watch login info in %s mode", self._file_watcher.mode())
         try:
             while True:
                 try:
@@ -362,5 +575,9 @@ class Manager(object):
                 except KeyboardInterrupt:
                     print()
         finally:
+            if self._file_watcher is not None:
+                self._file_watcher.stop()
+            # login info loaded lazily is not in the snapshot yet
+            self._login_info_manager.save_snapshot()
             self._make_sure_directory_exists(history_file_path)
             readline.write_history_file(history_file_path)
@@ -116,8 +116,59 @@ class Setting(object):
 _default_setting = {
     "HISTORY_FILE_PATH": "~/.slm/slm.hist",
     "LOGIN_INFO_ROOT_PATH": "~/.slm/info",
+    # a private directory of caches of current user, created with mode 0700
+    "CACHE_PATH": "~/.slm/cache",
+    # a snapshot of parsed login info, default: a file of the root path in CACHE_PATH,
+    # it is ignored if it is not owned by current user or writable by others
+    "LOGIN_INFO_SNAPSHOT_ENABLED": True,
+    "LOGIN_INFO_SNAPSHOT_PATH": None,
+    # eager: load all login info on start-up, lazy: load login info on first access
+    "LOGIN_INFO_LOADING": "eager",
+    # processes to parse login info in eager loading, 0 means number of cpus
+    "LOGIN_INFO_LOADING_WORKERS": 1,
+    # a compiled inventory file which is memory mapped instead of loading login info
+    "LOGIN_INFO_INVENTORY_PATH": None,
+    # compile the inventory again on start-up if any login info file is changed,
+    # it stats every file, otherwise changes are seen after reload
+    "LOGIN_INFO_INVENTORY_CHECK": False,
+    # apply changes of login info in background, mode: auto, inotify or polling
+    "WATCH_LOGIN_INFO": False,
+    "WATCH_MODE": "auto",
+    "WATCH_POLL_INTERVAL": 5,
     "TMP_BIN_PATH": "/tmp/slm/bin",
     "LOG_FILE_PATH": "/tmp/slm/log/slm.log",
     "LOG_LEVEL": "INFO",
+    # socket name of the tmux server to login in, like `tmux -L`, None for the default server
+    "TMUX_SOCKET_NAME": None,
+    # watch output of panes by a tmux control mode client instead of polling
+    "TMUX_CONTROL_MODE": True,
+    # number of panes logging in at the same time in mlogin and run
+    "MLOGIN_CONCURRENCY": 10,
+    # seconds to wait for a command of run to finish
+    "RUN_TIMEOUT": 600,
+    # where run logs in: pty runs a local shell in a pseudo terminal, tmux uses panes
+    "RUN_BACKEND": "pty",
+    # share one ssh connection among logins to the same first hop, only if
+    # LOGIN_FORMAT starts with ssh, see ControlMaster in ssh_config(5). The
+    # directory of SSH_CONTROL_PATH must be owned by the user with mode 0700,
+    # masters are asked to stop when slm exits
+    "SSH_CONTROL_MASTER": False,
+    "SSH_CONTROL_PATH": "~/.slm/ssh/%C",
+    "SSH_CONTROL_PERSIST": 600,
+    # login and mlogin return to the shell at once and log in as background
+    # jobs, see the jobs command. It's off by default, so the shell waits for
+    # logins and prints their results as before
+    "BACKGROUND_LOGIN": False,
+    # records of time spent in phases of logging in to keep for the stats command
+    "LOGIN_STATS_SIZE": 10000,
+    # a file to append these records to as json lines, None to keep them in memory only
+    "LOGIN_METRICS_PATH": None,
+    # seconds to keep secrets fetched by SECRETS_HOOK in memory, so logins in
+    # that time don't run the hook again. Secrets are never written to disk and
+    # are dropped on exit. 0 keeps no secret and runs the hook on every login
+    "SECRETS_CACHE_TTL": 0,
+    # a hook to fetch secrets of all credentials of a login in one call, the
+    # secrets are kept by the cache, so it is only used if SECRETS_CACHE_TTL > 0
+    "SECRETS_BATCH_HOOK": None,
 }
 setting = ReadOnlySetting(_default_setting)
@@ -0,0 +1,256 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _visible_dirs(root_path):
+    """yield root path and all its sub directories which are not hidden"""
+    yield root_path
+    try:
+        entries = list(os.scandir(root_path))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from _visible_dirs(entry.path)
+
+
+class InotifyBackend(object):
+    """Wait for changes with inotify, only available on linux."""
+
+    def __init__(self, root_path, name_filter):
+        self._root_path = root_path
+        self._name_filter = name_filter
+        self._watches = {}
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._add_watches(root_path)
+
+    @staticmethod
+    def available():
+        if not sys.platform.startswith("linux"):
+            return False
+        libc_path = ctypes.util.find_library("c")
+        if libc_path is None:
+            return False
+        return hasattr(ctypes.CDLL(libc_path), "inotify_init1")
+
+    def _add_watches(self, path):
+        for dir_path in _visible_dirs(path):
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(dir_path), WATCH_MASK
+            )
+            if wd < 0:
+                logger.warning(
+                    "failed to watch %s: %s",
+                    dir_path,
+                    os.strerror(ctypes.get_errno()),
+                )
+            else:
+                self._watches[wd] = dir_path
+
+    def wait(self, timeout):
+        """
+        Wait for changes.
+
+        :timeout: seconds to wait
+        :returns: True if there is any change
+
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        data = os.read(self._fd, 65536)
+        changed = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed = True
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if name != "" and not self._name_filter(name):
+                continue
+            changed = True
+            if (
+                mask & IN_ISDIR
+                and mask & (IN_CREATE | IN_MOVED_TO)
+                and wd in self._watches
+            ):
+                self._add_watches(os.path.join(self._watches[wd], name))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingBackend(object):
+    """Wait for changes by comparing mtime and size of all files periodically."""
+
+    def __init__(self, root_path, name_filter, interval, sleep=time.sleep):
+        self._root_path = root_path
+        self._name_filter = name_filter
+        self._interval = interval
+        self._sleep = sleep
+        self._signature = self._scan()
+
+    def _scan(self):
+        signature = {}
+        for dir_path in _visible_dirs(self._root_path):
+            try:
+                entries = list(os.scandir(dir_path))
+            except OSError:
+                continue
+            for entry in entries:
+                if not self._name_filter(entry.name):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=True)
+                except OSError:
+                    continue
+                signature[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return signature
+
+    def wait(self, timeout):
+        self._sleep(min(timeout, self._interval))
+        signature = self._scan()
+        changed = signature != self._signature
+        self._signature = signature
+        return changed
+
+    def close(self):
+        pass
+
+
+class FileWatcher(object):
+    """
+    Watch a directory tree in a daemon thread. The callback is called once
+    changes settle down, so a burst of changes like a `git pull` only
+    triggers it once.
+    """
+
+    def __init__(
+        self,
+        root_path,
+        callback,
+        mode="auto",
+        poll_interval=5,
+        settle_time=0.5,
+        name_filter=None,
+    ):
+        """
+        :root_path: root of the directory tree
+        :callback: function to call after changes
+        :mode: auto, inotify or polling
+        :poll_interval: seconds between two scans in polling mode
+        :settle_time: seconds without changes before calling callback
+        :name_filter: a function to tell whether changes of a file name matter
+        """
+        self._root_path = root_path
+        self._callback = callback
+        self._mode = mode
+        self._poll_interval = poll_interval
+        self._settle_time = settle_time
+        self._name_filter = name_filter if name_filter is not None else bool
+        self._backend = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _create_backend(self):
+        if self._mode in ("auto", "inotify") and InotifyBackend.available():
+            try:
+                return InotifyBackend(self._root_path, self._name_filter)
+            except OSError:
+                if self._mode == "inotify":
+                    raise
+                logger.warning("inotify is not usable, fall back to polling")
+        elif self._mode == "inotify":
+            raise Exception("inotify is not available")
+        return PollingBackend(
+            self._root_path,
+            self._name_filter,
+            self._poll_interval,
+            self._stopped.wait,
+        )
+
+    def mode(self):
+        if isinstance(self._backend, InotifyBackend):
+            return "inotify"
+        return "polling"
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._backend = self._create_backend()
+        self._thread = threading.Thread(
+            target=self._run, name="slm-file-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self._backend.close()
+
+    def _run(self):
+        pending = False
+        while not self._stopped.is_set():
+            try:
+                timeout = self._settle_time if pending else 1
+                if self._backend.wait(timeout):
+                    pending = True
+                    continue
+                if pending:
+                    pending = False
+                    self._callback()
+            except Exception:
+                logger.warning("file watcher failed", exc_info=True)
+                self._stopped.wait(self._poll_interval)
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """A background job logging in some targets, it records the phase of every target."""
+
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    # phases of a target after it is finished
+    DONE_PHASE = "done"
+    FAILED_PHASE = "failed"
+    CANCELLED_PHASE = "cancelled"
+
+    def __init__(self, id, name, target_ids):
+        """
+        :id: id of the job
+        :name: name to display, like the command line
+        :target_ids: ids of target nodes
+        """
+        self._id = id
+        self._name = name
+        self._begin = time.monotonic()
+        self._end = None
+        # target id -> phase, like connecting, secrets, password, otp, hooks
+        self._phases = {target_id: "queued" for target_id in target_ids}
+        self._state = self.RUNNING
+        self._summary = []
+        self._future = None
+        # set after the job is finished, cancelled or failed
+        self._done = threading.Event()
+
+    def id(self):
+        return self._id
+
+    def name(self):
+        return self._name
+
+    def state(self):
+        return self._state
+
+    def elapsed(self):
+        end = self._end if self._end is not None else time.monotonic()
+        return end - self._begin
+
+    def phases(self):
+        """:returns: a list of (target id, phase)"""
+        return list(self._phases.items())
+
+    def summary(self):
+        """:returns: lines to describe the result of a finished job"""
+        return self._summary
+
+    def progress(self, target_id):
+        """:returns: a function to set the phase of a target"""
+
+        def set_phase(phase):
+            self._phases[target_id] = phase
+
+        return set_phase
+
+    def cancel(self):
+        if self._future is not None:
+            self._future.cancel()
+
+    def _finish(self, state, summary):
+        self._end = time.monotonic()
+        self._state = state
+        self._summary = summary
+        if state == self.CANCELLED:
+            for target_id, phase in self._phases.items():
+                if phase not in (self.DONE_PHASE, self.FAILED_PHASE):
+                    self._phases[target_id] = self.CANCELLED_PHASE
+
+
+class JobManager(object):
+    """
+    Run jobs in an event loop of a daemon thread, so the shell doesn't wait
+    for them. The thread is started on first submission.
+    """
+
+    # finished jobs to keep for `jobs`
+    MAX_FINISHED_JOBS = 20
+    # seconds to wait for cancelled jobs on close
+    CLOSE_TIMEOUT = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._jobs = []
+        self._next_id = 1
+        # lines to print before next prompt, like a shell prints finished jobs
+        self._notifications = []
+
+    def _start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="slm-jobs", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, name, target_ids, coroutine_function):
+        """
+        Run a job in background.
+
+        :name: name of the job
+        :target_ids: ids of target nodes
+        :coroutine_function: called with the job, returns lines of summary
+        :returns: a Job
+
+        """
+        with self._lock:
+            if self._loop is None:
+                self._start()
+            job = Job(self._next_id, name, target_ids)
+            self._next_id += 1
+            self._jobs.append(job)
+        job._future = asyncio.run_coroutine_threadsafe(
+            self._run(job, coroutine_function), self._loop
+        )
+        return job
+
+    async def _run(self, job, coroutine_function):
+        try:
+            job._finish(Job.FINISHED, await coroutine_function(job))
+        except asyncio.CancelledError:
+            job._finish(Job.CANCELLED, [])
+            raise
+        except Exception as e:
+            logger.warning("job %s failed", job.name(), exc_info=True)
+            job._finish(Job.FAILED, [str(e)])
+        finally:
+            self._on_finished(job)
+            job._done.set()
+
+    def _on_finished(self, job):
+        with self._lock:
+            self._notifications.append(
+                "[{}] {} {}".format(job.id(), job.state(), job.name())
+            )
+            self._notifications.extend(job.summary())
+            finished_jobs = [j for j in self._jobs if j.state() != Job.RUNNING]
+            for j in finished_jobs[: -self.MAX_FINISHED_JOBS]:
+                self._jobs.remove(j)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def job(self, id):
+        with self._lock:
+            for job in self._jobs:
+                if job.id() == id:
+                    return job
+        return None
+
+    def pop_notifications(self):
+        with self._lock:
+            notifications = self._notifications
+            self._notifications = []
+        return notifications
+
+    def close(self):
+        """
+        Cancel running jobs and wait for them to unwind, at most
+        CLOSE_TIMEOUT seconds, then stop the event loop.
+        """
+        if self._loop is None:
+            return
+        jobs = self.jobs()
+        for job in jobs:
+            job.cancel()
+        deadline = time.monotonic() + self.CLOSE_TIMEOUT
+        for job in jobs:
+            if not job._done.wait(max(0, deadline - time.monotonic())):
+                logger.warning("job %s is not finished on close", job.name())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(1)
@@ -0,0 +1,114 @@
+import collections
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, p):
+    """
+    The nearest-rank percentile.
+
+    :values: sorted numbers
+    :p: percent, from 0 to 100
+    :returns: the percentile, or None if there is no value
+
+    """
+    if len(values) == 0:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+class LoginStats(object):
+    """
+    Time spent in every phase of logging in. Recent records are kept in a
+    ring buffer, and they are appended to a metrics file as json lines if a
+    path is given.
+    """
+
+    def __init__(self, size, metrics_path=None):
+        """
+        :size: number of records to keep in memory
+        :metrics_path: a file to append records to, or None
+        """
+        self._lock = threading.Lock()
+        self._records = collections.deque(maxlen=max(1, size))
+        self._metrics_path = metrics_path
+        self._metrics_file = None
+
+    def record(self, phase, host, bastion, seconds):
+        """
+        :phase: name of the phase
+        :host: id of the node logged in during the phase
+        :bastion: id of the first hop if the host is reached through it, or None
+        :seconds: time spent in the phase
+        """
+        record = {
+            "time": time.time(),
+            "phase": phase,
+            "host": host,
+            "bastion": bastion,
+            "seconds": seconds,
+        }
+        with self._lock:
+            self._records.append(record)
+            if self._metrics_path is not None:
+                self._write(record)
+
+    def _write(self, record):
+        try:
+            if self._metrics_file is None:
+                path = os.path.expanduser(self._metrics_path)
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self._metrics_file = open(path, "a", buffering=1)
+            self._metrics_file.write(json.dumps(record) + "\n")
+        except OSError:
+            logger.warning("write login metrics failed, stop writing", exc_info=True)
+            self._metrics_path = None
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def summary(self, group_by=None):
+        """
+        Summarize records by phase.
+
+        :group_by: None, host or bastion, records without a bastion are
+            skipped when grouped by bastion
+        :returns: a list of (group, phase, count, p50, p95, max) sorted by group,
+            group is None if group_by is None
+
+        """
+        groups = {}
+        for record in self.records():
+            group = None if group_by is None else record[group_by]
+            if group_by is not None and group is None:
+                continue
+            groups.setdefault((group, record["phase"]), []).append(record["seconds"])
+        rows = []
+        for (group, phase), values in groups.items():
+            values.sort()
+            rows.append(
+                (
+                    group,
+                    phase,
+                    len(values),
+                    percentile(values, 50),
+                    percentile(values, 95),
+                    values[-1],
+                )
+            )
+        rows.sort(key=lambda row: ("" if row[0] is None else row[0], row[1]))
+        return rows
+
+    def close(self):
+        with self._lock:
+            if self._metrics_file is not None:
+                self._metrics_file.close()
+                self._metrics_file = None
@@ -0,0 +1,168 @@
+import json
+import logging
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _run_hook(hook, input=None):
+    """
+    Run a hook and parse its output as json.
+
+    :hook: a shell command string, or a list of arguments
+    :input: bytes to write to stdin of the hook
+    :returns: parsed output
+
+    """
+    if isinstance(hook, str):
+        shell = True
+    elif isinstance(hook, (list, tuple)):
+        shell = False
+        hook = list(hook)
+    else:
+        raise Exception("unknown type of hook: {}".format(type(hook)))
+    process = subprocess.run(
+        hook,
+        shell=shell,
+        check=True,
+        input=input,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if input is None else subprocess.PIPE,
+    )
+    output = str(process.stdout, "utf8")
+    return json.loads(output)
+
+
+def fetch_secrets(credential):
+    """
+    Fetch secrets of a credential, by running its SECRETS_HOOK if there is one.
+
+    :credential: a credential dict
+    :returns: (password, otp options)
+
+    """
+    hook = credential.get("SECRETS_HOOK")
+    if hook is None:
+        return (credential.get("PASSWORD"), None)
+    secrets = _run_hook(hook)
+    return (secrets.get("PASSWORD"), secrets.get("OTP_OPTIONS"))
+
+
+def credential_key(credential):
+    """a key to identify a credential, which doesn't include its password"""
+    return json.dumps(
+        {k: v for k, v in credential.items() if k != "PASSWORD"},
+        sort_keys=True,
+        default=str,
+    )
+
+
+class SecretCache(object):
+    """
+    An in-memory cache of secrets fetched by SECRETS_HOOK. Secrets are only
+    kept in memory and expire after ttl seconds. Concurrent logins waiting for
+    the same credential share one call of the hook.
+    """
+
+    def __init__(self, ttl, batch_hook=None):
+        """
+        :ttl: seconds to keep secrets, 0 means no caching
+        :batch_hook: a hook to fetch secrets of many credentials in one call
+        """
+        self._ttl = ttl
+        self._batch_hook = batch_hook
+        self._lock = threading.Lock()
+        # key -> (expire time, (password, otp options))
+        self._entries = {}
+        # key -> lock held while fetching secrets of the key
+        self._fetching_locks = {}
+
+    def _get_entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def _put_entry(self, key, secrets):
+        if self._ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, secrets)
+
+    def get(self, credential):
+        """
+        Get secrets of a credential, the hook is only called if they are not
+        in cache.
+
+        :credential: a credential dict
+        :returns: (password, otp options)
+
+        """
+        if credential.get("SECRETS_HOOK") is None:
+            return fetch_secrets(credential)
+        key = credential_key(credential)
+        secrets = self._get_entry(key)
+        if secrets is not None:
+            return secrets
+        with self._lock:
+            fetching_lock = self._fetching_locks.setdefault(key, threading.Lock())
+        with fetching_lock:
+            # it may be fetched while waiting for the lock
+            secrets = self._get_entry(key)
+            if secrets is None:
+                secrets = fetch_secrets(credential)
+                self._put_entry(key, secrets)
+        return secrets
+
+    def prefetch(self, credentials):
+        """
+        Fetch secrets of credentials not in cache by one call of the batch hook.
+
+        The batch hook reads a json list of credentials without password from
+        stdin, each of which has an extra field ID, and writes a json object
+        from ID to {"PASSWORD": ..., "OTP_OPTIONS": ...}. Credentials missing
+        in the output will be fetched by their own SECRETS_HOOK later.
+
+        :credentials: credential dicts
+
+        """
+        if self._batch_hook is None or self._ttl <= 0:
+            return
+        requests = {}
+        for credential in credentials:
+            if credential.get("SECRETS_HOOK") is None:
+                continue
+            key = credential_key(credential)
+            if key in requests or self._get_entry(key) is not None:
+                continue
+            request = {k: v for k, v in credential.items() if k != "PASSWORD"}
+            request["ID"] = str(len(requests))
+            requests[key] = request
+        if len(requests) == 0:
+            return
+        try:
+            results = _run_hook(
+                self._batch_hook,
+                json.dumps(list(requests.values()), default=str).encode("utf8"),
+            )
+        except Exception:
+            logger.warning("batch secrets hook failed", exc_info=True)
+            return
+        for key, request in requests.items():
+            secrets = results.get(request["ID"])
+            if secrets is not None:
+                self._put_entry(
+                    key, (secrets.get("PASSWORD"), secrets.get("OTP_OPTIONS"))
+                )
+
+    def wipe(self):
+        """drop all secrets"""
+        with self._lock:
+            self._entries.clear()
+            self._fetching_locks.clear()
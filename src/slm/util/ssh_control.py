@@ -0,0 +1,83 @@
+import logging
+import os
+import stat
+import subprocess
+
+from ..setting import setting
+
+logger = logging.getLogger(__name__)
+
+
+def _ssh_path():
+    """:returns: the ssh program of LOGIN_FORMAT, or None if it isn't ssh"""
+    words = setting.LOGIN_FORMAT.split(None, 1)
+    if len(words) == 0 or os.path.basename(words[0]) != "ssh":
+        return None
+    return words[0]
+
+
+def _check_directory(directory):
+    """:returns: an error message if the directory is unsafe for master sockets, or None"""
+    try:
+        st = os.lstat(directory)
+    except OSError as e:
+        return str(e)
+    if not stat.S_ISDIR(st.st_mode):
+        return "{} is not a directory".format(directory)
+    if st.st_uid != os.getuid():
+        return "{} is not owned by the current user".format(directory)
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        return "mode of {} is {:o}, not 700".format(directory, stat.S_IMODE(st.st_mode))
+    return None
+
+
+def control_path():
+    """
+    ControlPath of ssh master connections. Other users could hijack the
+    masters through their sockets, so the directory is created with mode
+    0700 and refused unless it is owned by the current user with mode 0700.
+
+    :returns: the ControlPath, or None if SSH_CONTROL_MASTER is disabled,
+        LOGIN_FORMAT isn't ssh or the directory is unsafe
+
+    """
+    if not setting.SSH_CONTROL_MASTER or _ssh_path() is None:
+        return None
+    path = os.path.expanduser(setting.SSH_CONTROL_PATH)
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    except OSError:
+        logger.warning("create %s failed", directory, exc_info=True)
+    error = _check_directory(directory)
+    if error is not None:
+        print("ssh master connections are not shared: {}".format(error))
+        logger.warning("ssh master connections are not shared: %s", error)
+        return None
+    return path
+
+
+def stop_masters():
+    """
+    Ask master connections in the directory of SSH_CONTROL_PATH to stop
+    accepting new sessions, they exit after their sessions are closed,
+    instead of lingering for SSH_CONTROL_PERSIST after slm exits.
+    """
+    ssh = _ssh_path()
+    if not setting.SSH_CONTROL_MASTER or ssh is None:
+        return
+    directory = os.path.dirname(os.path.expanduser(setting.SSH_CONTROL_PATH))
+    if _check_directory(directory) is not None:
+        return
+    for entry in os.scandir(directory):
+        if not stat.S_ISSOCK(entry.stat(follow_symlinks=False).st_mode):
+            continue
+        try:
+            subprocess.run(
+                [ssh, "-o", "ControlPath=" + entry.path, "-O", "stop", "slm"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=5,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            logger.warning("stop ssh master %s failed", entry.path, exc_info=True)
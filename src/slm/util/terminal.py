@@ -0,0 +1,418 @@
+import asyncio
+import codecs
+import collections
+import fcntl
+import logging
+import os
+import pty
+import signal
+import struct
+import subprocess
+import termios
+import time
+
+from .tmux_control import ESCAPE_SEQUENCE_RE, _PaneState, _match
+
+logger = logging.getLogger(__name__)
+
+
+class Terminal(object):
+    """
+    A terminal to login in, commands are typed into it and prompts are
+    waited from its output. All methods are called in an event loop.
+    """
+
+    async def open(self):
+        """prepare the terminal before logging in"""
+
+    async def close(self):
+        """release the terminal after it is not needed"""
+
+    async def select(self):
+        """bring the terminal to the front if it is visible"""
+
+    async def clear(self):
+        """clear the screen before logging in"""
+
+    async def send_keys(self, keys, suppress_history=True):
+        """
+        Type keys and enter.
+
+        :keys: keys to type
+        :suppress_history: prefix a space to keep keys out of shell history
+        """
+        raise NotImplementedError()
+
+    async def wait_until_any(self, prompts, timeout):
+        """
+        Wait until the last line of the terminal ends with any of prompts.
+
+        :prompts: prompts, None is ignored
+        :timeout: seconds to wait
+        :returns: the prompt encountered, or None if timeout
+
+        """
+        raise NotImplementedError()
+
+    async def wait_until(self, prompt, timeout):
+        return await self.wait_until_any([prompt], timeout) is not None
+
+    async def add_output_listener(self, listener):
+        """
+        Call listener in the event loop with every chunk of output.
+
+        :listener: a function accepting a string
+        :returns: a function to remove the listener, or None if output can't be listened
+
+        """
+        return None
+
+    async def capture(self):
+        """:returns: lines on the screen and in history"""
+        raise NotImplementedError()
+
+    async def send_keys_until_line(self, keys, pattern, timeout):
+        """
+        Type keys and wait for a line of output matching a pattern. Output is
+        listened if possible, or else the screen is captured periodically.
+
+        :keys: keys to type
+        :pattern: a compiled regular expression
+        :timeout: seconds to wait
+        :returns: the match of the last matched line, or None if timeout
+
+        """
+        loop = asyncio.get_running_loop()
+        found = loop.create_future()
+        pending = [""]
+
+        def feed(text):
+            lines = (pending[0] + text).split("\n")
+            pending[0] = lines.pop()
+            for line in lines:
+                match = pattern.search(ESCAPE_SEQUENCE_RE.sub("", line))
+                if match is not None and not found.done():
+                    found.set_result(match)
+
+        remove_listener = await self.add_output_listener(feed)
+        await self.send_keys(keys)
+        if remove_listener is None:
+            return await self._poll_line(pattern, timeout)
+        try:
+            return await asyncio.wait_for(found, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            remove_listener()
+
+    async def send_keys_until_prompt(self, keys, prompt, timeout):
+        """
+        Type keys and wait for the prompt printed after them. Unlike
+        wait_until, the prompt on the last line before typing is not taken,
+        it works for shells which can't echo a sentinel.
+
+        :keys: keys to type
+        :prompt: prompt to wait
+        :timeout: seconds to wait
+        :returns: True if the prompt is printed in time, or else False
+
+        """
+        loop = asyncio.get_running_loop()
+        found = loop.create_future()
+        state = _PaneState()
+        # the prompt counts after the line of typed keys is ended
+        new_line = [False]
+
+        def feed(text):
+            state.feed(text)
+            if "\n" in text:
+                new_line[0] = True
+            if (
+                new_line[0]
+                and _match(state.line.strip(), [prompt]) is not None
+                and not found.done()
+            ):
+                found.set_result(True)
+
+        remove_listener = await self.add_output_listener(feed)
+        if remove_listener is None:
+            lines = await self.capture()
+            await self.send_keys(keys)
+            return await self._poll_prompt(prompt, lines, timeout)
+        await self.send_keys(keys)
+        try:
+            return await asyncio.wait_for(found, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            remove_listener()
+
+    async def _poll_prompt(self, prompt, old_lines, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            lines = await self.capture()
+            # typed keys are echoed after the old prompt, so the screen is
+            # changed before a new prompt is printed
+            if (
+                lines != old_lines
+                and len(lines) > 0
+                and _match(lines[-1].strip(), [prompt]) is not None
+            ):
+                return True
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.1)
+
+    async def _poll_line(self, pattern, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            for line in reversed(await self.capture()):
+                match = pattern.search(line)
+                if match is not None:
+                    return match
+            if time.monotonic() > deadline:
+                return None
+            await asyncio.sleep(0.1)
+
+    def name(self):
+        raise NotImplementedError()
+
+
+class TmuxTerminal(Terminal):
+    """a tmux pane, given as a libtmux pane or a pane id"""
+
+    def __init__(self, pane):
+        self._pane = pane
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def select(self):
+        from .tmux_util import select_pane
+
+        await self._run(select_pane, self._pane)
+
+    async def clear(self):
+        await self.send_keys("clear")
+
+    async def send_keys(self, keys, suppress_history=True):
+        from .tmux_util import async_send_keys
+
+        await async_send_keys(self._pane, keys, suppress_history=suppress_history)
+
+    async def wait_until_any(self, prompts, timeout):
+        from .tmux_util import async_wait_until_any
+
+        return await async_wait_until_any(self._pane, prompts, timeout)
+
+    async def add_output_listener(self, listener):
+        from .tmux_util import add_output_listener
+
+        loop = asyncio.get_running_loop()
+        return await self._run(
+            add_output_listener,
+            self._pane,
+            lambda text: loop.call_soon_threadsafe(listener, text),
+        )
+
+    async def capture(self):
+        from .tmux_util import capture_pane
+
+        return await self._run(capture_pane, self._pane)
+
+    def name(self):
+        from .tmux_util import _pane_id
+
+        return _pane_id(self._pane)
+
+
+def _set_controlling_terminal():
+    # ssh reads passwords from /dev/tty, so the pty must be the controlling terminal
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+class PtyTerminal(Terminal):
+    """
+    A local shell in a pseudo terminal without tmux. Its output is read in
+    the event loop, so many of them can be driven concurrently.
+    """
+
+    # lines of output kept for capture, like the history captured from a tmux pane
+    HISTORY_LINES = 1000
+
+    def __init__(self, shell="/bin/sh", columns=250, rows=50):
+        """
+        :shell: shell to type the first login command in
+        :columns: width of the terminal, long lines are not wrapped in a wide terminal
+        :rows: height of the terminal
+        """
+        self._shell = shell
+        self._columns = columns
+        self._rows = rows
+        self._process = None
+        self._fd = None
+        self._state = _PaneState()
+        # ended lines of output, the last line is in _state
+        self._lines = collections.deque(maxlen=self.HISTORY_LINES)
+        self._decoder = codecs.getincrementaldecoder("utf8")("replace")
+        self._listeners = []
+        # [(prompts, future)]
+        self._waiters = []
+        self._closed = False
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        master_fd, slave_fd = pty.openpty()
+        fcntl.ioctl(
+            slave_fd,
+            termios.TIOCSWINSZ,
+            struct.pack("HHHH", self._rows, self._columns, 0, 0),
+        )
+        env = dict(os.environ)
+        env["TERM"] = "dumb"
+        # a local prompt could be taken as the shell prompt of a node
+        env["PS1"] = ""
+        env["PS2"] = ""
+        try:
+            self._process = subprocess.Popen(
+                [self._shell],
+                stdin=slave_fd,
+                stdout=slave_fd,
+                stderr=slave_fd,
+                env=env,
+                preexec_fn=_set_controlling_terminal,
+            )
+        finally:
+            os.close(slave_fd)
+        os.set_blocking(master_fd, False)
+        self._fd = master_fd
+        loop.add_reader(master_fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO after the shell exits
+            data = b""
+        if len(data) == 0:
+            self._on_closed()
+            return
+        text = self._decoder.decode(data)
+        self._feed(text)
+        for listener in list(self._listeners):
+            try:
+                listener(text)
+            except Exception:
+                logger.warning("output listener failed", exc_info=True)
+        out = self._state.line.strip()
+        remaining_waiters = []
+        for prompts, future in self._waiters:
+            prompt = _match(out, prompts)
+            if prompt is None:
+                remaining_waiters.append((prompts, future))
+            elif not future.done():
+                future.set_result(prompt)
+        self._waiters = remaining_waiters
+
+    def _feed(self, text):
+        segments = text.split("\n")
+        for segment in segments[:-1]:
+            self._state.feed(segment)
+            self._lines.append(self._state.line)
+            self._state.line = ""
+        self._state.feed(segments[-1])
+
+    def _on_closed(self):
+        if self._closed:
+            return
+        self._closed = True
+        asyncio.get_running_loop().remove_reader(self._fd)
+        # a prompt will never appear
+        for _, future in self._waiters:
+            if not future.done():
+                future.set_result(None)
+        self._waiters = []
+
+    async def close(self):
+        if self._process is None:
+            return
+        self._on_closed()
+        try:
+            os.killpg(self._process.pid, signal.SIGHUP)
+        except ProcessLookupError:
+            pass
+        os.close(self._fd)
+        process = self._process
+        self._process = None
+
+        def wait():
+            try:
+                process.wait(1)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+        await asyncio.get_running_loop().run_in_executor(None, wait)
+
+    async def send_keys(self, keys, suppress_history=True):
+        if self._closed:
+            return
+        if suppress_history:
+            keys = " " + keys
+        data = (keys + "\r").encode("utf8")
+        # the pty buffer is large enough for a command line
+        os.write(self._fd, data)
+
+    async def wait_until_any(self, prompts, timeout):
+        prompt = _match(self._state.line.strip(), prompts)
+        if prompt is not None or self._closed:
+            return prompt
+        future = asyncio.get_running_loop().create_future()
+        waiter = (prompts, future)
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    async def add_output_listener(self, listener):
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    async def capture(self):
+        """:returns: lines of output without escape sequences, at most HISTORY_LINES"""
+        lines = list(self._lines)
+        lines.append(self._state.line)
+        # like capture-pane, trailing empty lines are not returned
+        while len(lines) > 0 and lines[-1] == "":
+            lines.pop()
+        return lines
+
+    def name(self):
+        return "pty:{}".format(None if self._process is None else self._process.pid)
+
+
+def create_terminals(backend, window_name_prefix, amount):
+    """
+    Create terminals to login.
+
+    :backend: tmux or pty
+    :window_name_prefix: window name prefix of tmux panes
+    :amount: number of terminals
+    :returns: a list of terminals
+
+    """
+    if backend == "pty":
+        return [PtyTerminal() for _ in range(amount)]
+    if backend != "tmux":
+        raise Exception("unknown terminal backend: {}".format(backend))
+    from .tmux_util import new_tiled_panes
+
+    return [TmuxTerminal(pane) for pane in new_tiled_panes(window_name_prefix, amount)]
@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import re
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# CSI, OSC and other two-byte escape sequences
+ESCAPE_SEQUENCE_RE = re.compile(
+    r"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]"
+)
+OCTAL_ESCAPE_RE = re.compile(rb"\\([0-7]{3})")
+
+
+class ControlClientClosed(Exception):
+    pass
+
+
+def quote(arg):
+    """quote an argument for tmux command parser"""
+    if arg != "" and re.fullmatch(r"[\w@%+=:,./-]+", arg):
+        return arg
+    return "'" + arg.replace("'", "'\\''") + "'"
+
+
+def _match(out, prompts):
+    for prompt in prompts:
+        if prompt is not None and out.endswith(prompt):
+            return prompt
+    return None
+
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_future_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+
+class _PaneState(object):
+    """the last line of a pane, rebuilt from its output stream"""
+
+    __slots__ = ("line", "pending")
+
+    def __init__(self, line=""):
+        self.line = line
+        # an escape sequence split by two chunks of output
+        self.pending = ""
+
+    def feed(self, text):
+        text = self.pending + text
+        self.pending = ""
+        idx = text.rfind("\x1b")
+        if idx != -1 and ESCAPE_SEQUENCE_RE.match(text, idx) is None:
+            if len(text) - idx < 64:
+                self.pending = text[idx:]
+                text = text[:idx]
+        text = ESCAPE_SEQUENCE_RE.sub("", text)
+        segments = text.split("\n")
+        line = self.line if len(segments) == 1 else ""
+        parts = segments[-1].split("\r")
+        line += parts[0]
+        for part in parts[1:]:
+            # text after a carriage return overwrites the line
+            if part != "":
+                line = part
+        while "\b" in line:
+            idx = line.index("\b")
+            line = line[: max(idx - 1, 0)] + line[idx + 1 :]
+        self.line = line
+
+
+class ControlClient(object):
+    """
+    A persistent tmux client in control mode. tmux pushes the output of all
+    panes of the attached session to it, so a prompt is noticed as soon as
+    it is printed, without polling `capture-pane`.
+    """
+
+    def __init__(self, session_name, socket_name=None):
+        """
+        :session_name: session to attach
+        :socket_name: socket name of tmux server, the default server if it is None
+        """
+        self._session_name = session_name
+        self._socket_name = socket_name
+        self._process = None
+        self._reader = None
+        self._cond = threading.Condition()
+        self._command_lock = threading.Lock()
+        self._panes = {}
+        self._listeners = {}
+        # pane id -> [(prompts, future, loop)]
+        self._waiters = {}
+        self._responses = []
+        # responses of commands which timed out, they are dropped on arrival,
+        # tmux responds in order, so they come before responses of new commands
+        self._stale_responses = 0
+        self._closed = False
+
+    def start(self, timeout=5):
+        """
+        Attach to the session, the client doesn't affect sizes of windows.
+
+        :timeout: seconds to wait for attaching
+        """
+        args = ["tmux"]
+        if self._socket_name is not None:
+            args.extend(["-L", self._socket_name])
+        args.extend(["-C", "attach-session", "-t", self._session_name])
+        args.extend(["-f", "ignore-size"])
+        self._process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self._reader = threading.Thread(
+            target=self._read, name="slm-tmux-control", daemon=True
+        )
+        self._reader.start()
+        # the response of attach-session is the first block
+        self._wait_responses(1, timeout)
+
+    def close(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._process.wait(1)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+        self._process = None
+
+    def is_alive(self):
+        return not self._closed and self._process is not None
+
+    def _read(self):
+        block = None
+        try:
+            for raw_line in self._process.stdout:
+                raw_line = raw_line.rstrip(b"\n")
+                if block is not None:
+                    if raw_line.startswith((b"%end ", b"%error ")):
+                        with self._cond:
+                            if self._stale_responses > 0:
+                                self._stale_responses -= 1
+                            else:
+                                self._responses.append(
+                                    (raw_line.startswith(b"%end "), block)
+                                )
+                                self._cond.notify_all()
+                        block = None
+                    else:
+                        block.append(str(raw_line, "utf8", "replace"))
+                elif raw_line.startswith(b"%begin "):
+                    block = []
+                elif raw_line.startswith(b"%output "):
+                    self._on_output(raw_line)
+                elif raw_line.startswith(b"%exit"):
+                    break
+        except Exception:
+            logger.warning("tmux control client failed", exc_info=True)
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+                waiters = self._waiters
+                self._waiters = {}
+            for pane_waiters in waiters.values():
+                for _, future, loop in pane_waiters:
+                    loop.call_soon_threadsafe(
+                        _set_future_exception,
+                        future,
+                        ControlClientClosed("tmux control client is closed"),
+                    )
+
+    def _on_output(self, raw_line):
+        _, pane_id, data = raw_line.split(b" ", 2)
+        pane_id = str(pane_id, "utf8")
+        data = OCTAL_ESCAPE_RE.sub(lambda m: bytes([int(m.group(1), 8)]), data)
+        text = str(data, "utf8", "replace")
+        with self._cond:
+            state = self._panes.get(pane_id)
+            if state is None:
+                state = _PaneState()
+                self._panes[pane_id] = state
+            state.feed(text)
+            listeners = self._listeners.get(pane_id)
+            pane_waiters = self._waiters.get(pane_id)
+            if pane_waiters is not None:
+                out = state.line.strip()
+                remaining_waiters = []
+                for waiter in pane_waiters:
+                    prompt = _match(out, waiter[0])
+                    if prompt is None:
+                        remaining_waiters.append(waiter)
+                    else:
+                        waiter[2].call_soon_threadsafe(
+                            _set_future_result, waiter[1], prompt
+                        )
+                self._waiters[pane_id] = remaining_waiters
+        if listeners is not None:
+            for listener in listeners:
+                try:
+                    listener(text)
+                except Exception:
+                    logger.warning("output listener failed", exc_info=True)
+
+    def _wait_responses(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self._responses) < count:
+                remaining = deadline - time.monotonic()
+                if self._closed or remaining <= 0:
+                    # drop responses of these commands, including late ones
+                    self._stale_responses += count - len(self._responses)
+                    self._responses = []
+                    raise ControlClientClosed("no response from tmux control client")
+                self._cond.wait(remaining)
+            responses = self._responses[:count]
+            del self._responses[:count]
+        return responses
+
+    def commands(self, commands, timeout=10):
+        """
+        Send commands in one write and wait for all their responses.
+
+        :commands: a list of commands, each one is a list of arguments
+        :timeout: seconds to wait for responses
+        :returns: a list of (succeeded, output lines)
+
+        """
+        if not self.is_alive():
+            raise ControlClientClosed("tmux control client is closed")
+        data = "".join(
+            " ".join(quote(str(arg)) for arg in command) + "\n" for command in commands
+        )
+        with self._command_lock:
+            try:
+                self._process.stdin.write(data.encode("utf8"))
+                self._process.stdin.flush()
+            except OSError as e:
+                raise ControlClientClosed("tmux control client is closed") from e
+            return self._wait_responses(len(commands), timeout)
+
+    def last_line(self, pane_id):
+        with self._cond:
+            state = self._panes.get(pane_id)
+            return None if state is None else state.line
+
+    def seed(self, pane_id, line):
+        """set the last line of a pane whose output is not seen yet"""
+        with self._cond:
+            if pane_id not in self._panes:
+                self._panes[pane_id] = _PaneState(line)
+
+    def add_listener(self, pane_id, listener):
+        """call listener with every chunk of output of a pane"""
+        with self._cond:
+            self._listeners.setdefault(pane_id, []).append(listener)
+
+    def remove_listener(self, pane_id, listener):
+        with self._cond:
+            listeners = self._listeners.get(pane_id)
+            if listeners is not None and listener in listeners:
+                self._listeners[pane_id] = [l for l in listeners if l is not listener]
+
+    async def async_wait_until_any(self, pane_id, prompts, timeout):
+        """
+        Wait until the last line of a pane ends with any of prompts, in an
+        event loop without blocking it.
+
+        :pane_id: id of a pane, like %1
+        :prompts: prompts, None is ignored
+        :timeout: seconds to wait
+        :returns: the prompt encountered, or None if timeout
+
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (prompts, future, loop)
+        with self._cond:
+            state = self._panes.get(pane_id)
+            prompt = _match("" if state is None else state.line.strip(), prompts)
+            if prompt is not None:
+                return prompt
+            if self._closed:
+                raise ControlClientClosed("tmux control client is closed")
+            self._waiters.setdefault(pane_id, []).append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._cond:
+                pane_waiters = self._waiters.get(pane_id)
+                if pane_waiters is not None and waiter in pane_waiters:
+                    pane_waiters.remove(waiter)
@@ -1,13 +1,51 @@
-import libtmux
+import asyncio
+import logging
+import threading
 import time
 
-server = libtmux.Server()
-session = server.find_where({"session_name": "login"})
-if session is None:
-    session = server.new_session(session_name="login")
+from ..setting import setting
+from .tmux_control import ControlClient, ControlClientClosed
+
+logger = logging.getLogger(__name__)
+
+SESSION_NAME = "login"
 
 M_WINDOW_INDEX_DICT = {}
 
+_server = None
+_session = None
+_session_lock = threading.Lock()
+
+_control_client = None
+_control_client_lock = threading.Lock()
+_control_mode_available = True
+
+
+def get_session():
+    """
+    The tmux session to login, the tmux server is connected and the session
+    is created on first use, so starting slm doesn't need tmux.
+
+    :returns: a libtmux session
+
+    """
+    global _server, _session
+    with _session_lock:
+        if _session is None:
+            import libtmux
+
+            _server = libtmux.Server(socket_name=setting.TMUX_SOCKET_NAME)
+            session = _server.find_where({"session_name": SESSION_NAME})
+            if session is None:
+                session = _server.new_session(session_name=SESSION_NAME)
+            _session = session
+        return _session
+
+
+def get_server():
+    get_session()
+    return _server
+
 
 def new_pane_in_window(window_name):
     """
@@ -17,6 +55,7 @@ def new_pane_in_window(window_name):
     :returns: a new pane
 
     """
+    session = get_session()
     window = session.find_where({"window_name": window_name})
     pane = None
     if window is None:
@@ -28,14 +67,46 @@ def new_pane_in_window(window_name):
     return pane
 
 
+def run_commands(commands):
+    """
+    Run tmux commands in one round trip, over the control client if it is
+    available, or else in one tmux invocation separated by ";".
+
+    :commands: a list of commands, each one is a list of arguments
+    :returns: output lines of all commands
+
+    """
+    client = control_client()
+    if client is not None:
+        try:
+            outs = []
+            for succeeded, lines in client.commands(commands):
+                if not succeeded:
+                    logger.warning("tmux command failed: %s", " ".join(lines))
+                outs.extend(lines)
+            return outs
+        except ControlClientClosed:
+            logger.warning("tmux control client is closed, fall back to tmux")
+    args = []
+    for command in commands:
+        if len(args) > 0:
+            args.append(";")
+        args.extend(str(arg) for arg in command)
+    result = get_server().cmd(*args)
+    if len(result.stderr) > 0:
+        logger.warning("tmux command failed: %s", " ".join(result.stderr))
+    return result.stdout
+
+
 def new_tiled_panes(window_name_prefix, amount):
     """
     Create new windows with the same prefix, each window will
-    split into nine panes at most.
+    split into nine panes at most. All windows and panes are created
+    by one batch of tmux commands.
 
     :window_name_prefix: window name prefix of these panes
     :amount: total number of panes to be created
-    :returns: panes
+    :returns: ids of panes, like %1, which are accepted wherever a pane is
 
     """
     max_amount_in_a_window = 9
@@ -45,53 +116,136 @@ def new_tiled_panes(window_name_prefix, amount):
         index = 0
         M_WINDOW_INDEX_DICT[window_name_prefix] = index
     M_WINDOW_INDEX_DICT[window_name_prefix] = index + number_of_windows
-    count = 0
-    panes = []
-    while count < number_of_windows:
-        window_name = "%s-%d" % (window_name_prefix, index + count)
-        window = session.find_where({"window_name": window_name})
-        if window is not None:
-            window.kill_window()
-        window = session.new_window(window_name=window_name)
+    window_names = [
+        "%s-%d" % (window_name_prefix, index + count)
+        for count in range(0, number_of_windows)
+    ]
+
+    # window names may contain "." or ":", so windows are targeted by id
+    session_target = "=%s:" % SESSION_NAME
+    existing_windows = run_commands(
+        [["list-windows", "-t", session_target, "-F", "#{window_id} #{window_name}"]]
+    )
+    commands = []
+    for line in existing_windows:
+        window_id, _, window_name = line.partition(" ")
+        if window_name in window_names:
+            commands.append(["kill-window", "-t", window_id])
+    for count, window_name in enumerate(window_names):
+        # the new window becomes the current window of the session
+        commands.append(["new-window", "-t", session_target, "-n", window_name])
         # calculte number of panes
         amount_in_this_window = min(
             amount - count * max_amount_in_a_window, max_amount_in_a_window
         )
         for idx in range(0, amount_in_this_window - 1):
-            window.split_window()
+            commands.append(["split-window", "-t", session_target])
             # adjust tile after split in case of not enough space
-            window.select_layout("tiled")
-        panes.extend(window.panes)
-        count += 1
+            commands.append(["select-layout", "-t", session_target, "tiled"])
+    commands.append(
+        [
+            "list-panes",
+            "-s",
+            "-t",
+            session_target,
+            "-F",
+            "#{window_id} #{pane_id} #{window_name}",
+        ]
+    )
+
+    panes_by_window = {window_name: [] for window_name in window_names}
+    for line in run_commands(commands):
+        window_id, pane_id, window_name = line.split(" ", 2)
+        if window_name in panes_by_window:
+            panes_by_window[window_name].append((window_id, pane_id))
+    panes = []
+    for window_name in window_names:
+        for window_id, pane_id in panes_by_window[window_name]:
+            panes.append(pane_id)
     return panes
 
 
-def wait_until(pane, prompt, timeout):
-    outs = pane.cmd("capture-pane", "-p").stdout
-    if len(outs) < 1:
-        out = ""
-    else:
-        out = outs[-1].strip()
-    total = 0
-    while not out.endswith(prompt):
-        time.sleep(0.1)
-        total += 0.1
-        if total > timeout:
-            return False
-        outs = pane.cmd("capture-pane", "-p").stdout
-        if len(outs) < 1:
-            out = ""
-        else:
-            out = outs[-1].strip()
-    return True
+def _pane_id(pane):
+    """:pane: a libtmux pane or a pane id"""
+    if isinstance(pane, str):
+        return pane
+    try:
+        return pane.pane_id
+    except AttributeError:
+        return pane.get("pane_id")
+
+
+def _run_in_pane(pane, *args):
+    """
+    Run a tmux command targeting a pane, by run_commands, so a pane doesn't
+    have to be looked up as a libtmux object.
+
+    :pane: a libtmux pane or a pane id
+    :returns: output lines without trailing empty lines
+
+    """
+    outs = run_commands([[args[0], "-t", _pane_id(pane)] + list(args[1:])])
+    while len(outs) > 0 and outs[-1] == "":
+        outs.pop()
+    return outs
 
 
-def wait_until_any(pane, prompts, timeout):
-    outs = pane.cmd("capture-pane", "-p").stdout
+def select_pane(pane):
+    _run_in_pane(pane, "select-pane")
+
+
+def send_keys(pane, keys, enter=True, suppress_history=True):
+    """
+    :pane: a libtmux pane or a pane id
+    :keys: keys to send
+    :enter: send Enter after keys
+    :suppress_history: prepend a space to keys, so shells don't save them in history
+    """
+    args = [(" " if suppress_history else "") + keys]
+    if enter:
+        args.append("Enter")
+    _run_in_pane(pane, "send-keys", *args)
+
+
+def _last_line(pane):
+    outs = _run_in_pane(pane, "capture-pane", "-p")
     if len(outs) < 1:
-        out = ""
-    else:
-        out = outs[-1].strip()
+        return ""
+    return outs[-1].strip()
+
+
+def control_client():
+    """
+    The tmux control mode client attached to the login session, it is
+    started on first use.
+
+    :returns: a ControlClient, or None if control mode is disabled or unavailable
+
+    """
+    global _control_client, _control_mode_available
+    with _control_client_lock:
+        if not setting.TMUX_CONTROL_MODE or not _control_mode_available:
+            return None
+        if _control_client is not None and _control_client.is_alive():
+            return _control_client
+        if _control_client is not None:
+            logger.warning("tmux control client is closed, restart it")
+        # the session must exist before attaching to it
+        get_session()
+        _control_client = ControlClient(SESSION_NAME, setting.TMUX_SOCKET_NAME)
+        try:
+            _control_client.start()
+        except ControlClientClosed:
+            logger.warning("tmux control mode is not available, fall back to polling")
+            _control_client.close()
+            _control_client = None
+            _control_mode_available = False
+        return _control_client
+
+
+async def _async_poll_until_any(pane, prompts, timeout):
+    loop = asyncio.get_running_loop()
+    out = await loop.run_in_executor(None, _last_line, pane)
     total = 0
     while True:
         for prompt in prompts:
@@ -99,12 +253,71 @@ def wait_until_any(pane, prompts, timeout):
                 continue
             if out.endswith(prompt):
                 return prompt
-        time.sleep(0.1)
+        await asyncio.sleep(0.1)
         total += 0.1
         if total > timeout:
             return None
-        outs = pane.cmd("capture-pane", "-p").stdout
-        if len(outs) < 1:
-            out = ""
-        else:
-            out = outs[-1].strip()
+        out = await loop.run_in_executor(None, _last_line, pane)
+
+
+async def async_wait_until_any(pane, prompts, timeout):
+    """
+    Wait until the last line of a pane ends with any of prompts in an event
+    loop, so panes can be waited concurrently. Output of the pane is pushed
+    by the tmux control mode client if it is available, otherwise the pane
+    is captured every 100ms.
+
+    :pane: a pane
+    :prompts: prompts, None is ignored
+    :timeout: seconds to wait
+    :returns: the prompt encountered, or None if timeout
+
+    """
+    loop = asyncio.get_running_loop()
+    client = await loop.run_in_executor(None, control_client)
+    if client is not None:
+        pane_id = _pane_id(pane)
+        if client.last_line(pane_id) is None:
+            # output before attaching is unknown, start from the screen
+            client.seed(pane_id, await loop.run_in_executor(None, _last_line, pane))
+        begin = time.monotonic()
+        try:
+            return await client.async_wait_until_any(pane_id, prompts, timeout)
+        except ControlClientClosed:
+            logger.warning("tmux control client is closed, fall back to polling")
+            timeout -= time.monotonic() - begin
+    return await _async_poll_until_any(pane, prompts, timeout)
+
+
+async def async_send_keys(pane, keys, **kwargs):
+    """send keys to a pane without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, lambda: send_keys(pane, keys, **kwargs))
+
+
+def add_output_listener(pane, listener):
+    """
+    Call listener with every chunk of output of a pane, it is called in the
+    thread of the control client.
+
+    :pane: a pane
+    :listener: a function accepting a string
+    :returns: a function to remove the listener, or None if control mode is not available
+
+    """
+    client = control_client()
+    if client is None:
+        return None
+    pane_id = _pane_id(pane)
+    client.add_listener(pane_id, listener)
+    return lambda: client.remove_listener(pane_id, listener)
+
+
+def capture_pane(pane, history=1000):
+    """
+    :pane: a libtmux pane or a pane id
+    :history: number of lines in history to capture
+    :returns: lines of a pane, wrapped lines are joined
+
+    """
+    return _run_in_pane(pane, "capture-pane", "-p", "-J", "-S", str(-history))